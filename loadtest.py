@@ -0,0 +1,388 @@
+"""Нагрузочный тест бота без выхода в интернет.
+
+Поднимает локальные заглушки Telegram Bot API, er-api и «видеохостинга»
+с настраиваемой задержкой, направляет на них настоящее приложение из main.py
+и гоняет симулированных пользователей по сценариям ConversationHandler:
+калории (MENU→HEIGHT→…→ACTIVITY), валюты (CURRENCY_FROM/TO/AMOUNT и
+запрос одним сообщением),
+отзыв (FEEDBACK) и видео (VIDEO). В конце печатает пропускную способность
+и p50/p95/p99 задержки ответа по каждому обработчику.
+
+Пример:
+    python loadtest.py --users 2000 --api-latency 30 --rates-latency 200
+    python loadtest.py --users 2000 --workers 4   # многопроцессный режим
+    LOCAL_BOT_API_URL=http://127.0.0.1:18081 python loadtest.py   # заглушка как локальный сервер Bot API
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import random
+import tempfile
+import time
+import urllib.parse
+from collections import Counter, defaultdict
+
+# main.py читает настройки при импорте, поэтому окружение готовим заранее
+os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="loadtest-"))
+os.environ.setdefault("ADMIN_CHAT_ID", "1")
+os.environ.setdefault("FEEDBACK_FLUSH_INTERVAL", "2")
+# Заглушка видеохостинга отдаётся по localhost, её разбирает только generic-экстрактор
+os.environ.setdefault("YTDLP_EXTRACTORS", "TikTok.*,Instagram.*,Generic")
+os.environ.pop("WEBHOOK_URL", None)
+# Симулированные пользователи пишут намного быстрее живых, поэтому лимиты исходящих
+# сообщений по умолчанию сняты; чтобы проверить поведение под лимитами Telegram,
+# задайте OUTBOUND_GLOBAL_RATE / OUTBOUND_CHAT_RATE явно
+os.environ.setdefault("OUTBOUND_GLOBAL_RATE", "100000")
+os.environ.setdefault("OUTBOUND_CHAT_RATE", "100000")
+
+import tornado.web
+
+import main
+
+TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+FAKE_RATES = {
+    "RUB": 90.5, "UZS": 12400.0, "BYN": 3.27, "USD": 1.0, "EUR": 0.92,
+    "CHF": 0.88, "TJS": 10.9, "KGS": 89.3, "KZT": 470.2, "UAH": 41.1,
+}
+# Минимальный заголовок MP4, чтобы ответ распознавался как видео
+FAKE_VIDEO_HEAD = b"\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isomiso2"
+
+
+class FakeTelegram:
+    """Заглушка Bot API: отдаёт апдейты через getUpdates и принимает ответы бота."""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._updates = []
+        self._new_updates = asyncio.Event()
+        # chat_id -> список (предикат, Future), ждущих ответа бота
+        self._waiters = defaultdict(list)
+        self.calls = Counter()
+        # Сколько байт медиа пришло телом запроса, а сколько сервер прочитал с диска сам
+        self.upload_bytes = Counter()
+
+    def push(self, chat_id: int, text: str) -> None:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self._updates.append({"update_id": next(self._update_ids), "message": message})
+        self._new_updates.set()
+
+    def expect(self, chat_id: int, predicate) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append((predicate, future))
+        return future
+
+    def _deliver(self, chat_id: int, message: dict) -> None:
+        waiters = self._waiters.get(chat_id)
+        if not waiters:
+            return
+        for item in list(waiters):
+            predicate, future = item
+            if not future.done() and predicate(message):
+                future.set_result(message)
+                waiters.remove(item)
+        if not waiters:
+            del self._waiters[chat_id]
+
+    async def get_updates(self, offset: int, timeout: float) -> list:
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:100]
+
+    def close(self) -> None:
+        """Отпускает висящие long-poll запросы getUpdates."""
+        self._new_updates.set()
+
+    def _bot_message(self, chat_id: int, **content) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            **content,
+        }
+        self._deliver(chat_id, message)
+        return message
+
+    async def call(self, method: str, params: dict):
+        self.calls[method] += 1
+        if method == "getUpdates":
+            return await self.get_updates(int(params.get("offset", 0)), float(params.get("timeout", 0)))
+        if method == "getMe":
+            return BOT_USER
+        if method in ("setMyCommands", "deleteWebhook", "setWebhook"):
+            return True
+        chat_id = int(params.get("chat_id", 0))
+        if method in ("sendMessage", "editMessageText"):
+            return self._bot_message(chat_id, text=params.get("text", ""))
+        if method in ("sendVideo", "sendDocument", "sendAnimation"):
+            kind = method[len("send"):].lower()
+            file_id = params.get(kind) if isinstance(params.get(kind), str) else None
+            if file_id and file_id.startswith("file://"):
+                # Как локальный сервер Bot API: файл читается с общего тома по пути
+                path = urllib.parse.unquote(file_id[len("file://"):])
+                self.upload_bytes["local_path"] += os.path.getsize(path)
+                file_id = None
+            media = {
+                "file_id": file_id or f"file{next(self._message_ids)}",
+                "file_unique_id": f"u{next(self._message_ids)}",
+                "width": 720, "height": 1280, "duration": 10,
+            }
+            return self._bot_message(chat_id, **{kind: media})
+        return True
+
+
+class BotApiHandler(tornado.web.RequestHandler):
+    def initialize(self, fake: FakeTelegram, latency: float):
+        self.fake = fake
+        self.latency = latency
+
+    async def post(self, token: str, method: str):
+        params = {key: self.get_body_argument(key) for key in self.request.body_arguments}
+        self.fake.upload_bytes["multipart"] += sum(
+            len(part.body) for parts in self.request.files.values() for part in parts
+        )
+        if method != "getUpdates" and self.latency:
+            await asyncio.sleep(self.latency)
+        try:
+            result = await self.fake.call(method, params)
+        except FileNotFoundError:
+            self.write({"ok": False, "error_code": 400, "description": "Bad Request: file not found"})
+            return
+        self.write({"ok": True, "result": result})
+
+
+class RatesHandler(tornado.web.RequestHandler):
+    def initialize(self, latency: float):
+        self.latency = latency
+
+    async def get(self, base: str):
+        await asyncio.sleep(self.latency)
+        self.write({"result": "success", "base_code": base, "rates": FAKE_RATES})
+
+
+class VideoHandler(tornado.web.RequestHandler):
+    """Отдаёт «ролик» по адресу вида /tiktok.com/video/<id>.mp4."""
+
+    def initialize(self, latency: float, size: int):
+        self.latency = latency
+        self.body = FAKE_VIDEO_HEAD + b"\x00" * max(size - len(FAKE_VIDEO_HEAD), 0)
+
+    async def head(self, video_id: str):
+        self.set_header("Content-Type", "video/mp4")
+        self.set_header("Content-Length", str(len(self.body)))
+
+    async def get(self, video_id: str):
+        await asyncio.sleep(self.latency)
+        self.set_header("Content-Type", "video/mp4")
+        self.write(self.body)
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.fake = FakeTelegram()
+        self.latencies = defaultdict(list)
+        self.failures = Counter()
+        self.updates_sent = 0
+        self.base = f"http://127.0.0.1:{args.port}"
+
+    def make_server(self) -> tornado.web.Application:
+        args = self.args
+        return tornado.web.Application([
+            (r"/bot([^/]+)/(\w+)", BotApiHandler, {"fake": self.fake, "latency": args.api_latency / 1000}),
+            (r"/v6/latest/(\w+)", RatesHandler, {"latency": args.rates_latency / 1000}),
+            (r"/tiktok\.com/video/(\w+)\.mp4", VideoHandler,
+             {"latency": args.video_latency / 1000, "size": args.video_size * 1024}),
+        ])
+
+    async def step(self, chat_id: int, label: str, text: str, predicate=None) -> bool:
+        """Отправляет сообщение от пользователя и ждёт подходящего ответа бота."""
+        future = self.fake.expect(chat_id, predicate or (lambda message: True))
+        started = time.perf_counter()
+        self.fake.push(chat_id, text)
+        self.updates_sent += 1
+        try:
+            await asyncio.wait_for(future, self.args.step_timeout)
+        except asyncio.TimeoutError:
+            self.failures[label] += 1
+            return False
+        self.latencies[label].append(time.perf_counter() - started)
+        return True
+
+    async def calories_flow(self, chat_id: int) -> None:
+        steps = [
+            ("menu", "Рассчитать калории"),
+            ("get_height", str(random.randint(150, 200))),
+            ("get_weight", str(random.randint(45, 120))),
+            ("get_age", str(random.randint(16, 80))),
+            ("get_gender", random.choice(["Мужчина", "Женщина"])),
+            ("get_activity", str(random.randint(1, 5))),
+        ]
+        for label, text in steps:
+            if not await self.step(chat_id, label, text):
+                return
+
+    async def currency_flow(self, chat_id: int) -> None:
+        cur_from, cur_to = random.sample(main.AVAILABLE_CURRENCIES, 2)
+        steps = [
+            ("menu", "Конвертация валют"),
+            ("currency_from", cur_from),
+            ("currency_to", cur_to),
+            ("currency_amount", str(random.randint(1, 100000))),
+        ]
+        for label, text in steps:
+            if not await self.step(chat_id, label, text):
+                return
+
+    async def quick_currency_flow(self, chat_id: int) -> None:
+        cur_from, *targets = random.sample(main.AVAILABLE_CURRENCIES, random.randint(1, 4))
+        await self.step(chat_id, "quick_conversion", f"{random.randint(1, 100000)} {cur_from} {' '.join(targets)}")
+
+    async def feedback_flow(self, chat_id: int) -> None:
+        if await self.step(chat_id, "menu", "Оставить отзыв"):
+            await self.step(chat_id, "feedback", "Отличный бот, спасибо!")
+
+    async def video_flow(self, chat_id: int) -> None:
+        if not await self.step(chat_id, "menu", "Видео по вашей ссылке"):
+            return
+        video_id = random.randint(1, self.args.videos)
+        link = f"{self.base}/tiktok.com/video/{video_id}.mp4"
+        done = self.fake.expect(chat_id, lambda m: m.get("text", "").startswith("Если хотите"))
+        started = time.perf_counter()
+        if not await self.step(chat_id, "video_by_link", link):
+            return
+        try:
+            await asyncio.wait_for(done, self.args.step_timeout)
+        except asyncio.TimeoutError:
+            self.failures["video_total"] += 1
+            return
+        self.latencies["video_total"].append(time.perf_counter() - started)
+
+    async def user(self, chat_id: int) -> None:
+        await asyncio.sleep(random.random() * self.args.ramp_up)
+        if not await self.step(chat_id, "start", "/start"):
+            return
+        flows = [
+            self.calories_flow, self.currency_flow, self.quick_currency_flow,
+            self.feedback_flow, self.video_flow,
+        ]
+        weights = [
+            self.args.mix_calories, self.args.mix_currency, self.args.mix_quick_currency,
+            self.args.mix_feedback, self.args.mix_video,
+        ]
+        for _ in range(self.args.flows_per_user):
+            flow = random.choices(flows, weights)[0]
+            await flow(chat_id)
+            await self.step(chat_id, "check_back_to_menu", main.BACK_TO_MENU)
+
+    async def run(self) -> None:
+        server = self.make_server().listen(self.args.port, address="127.0.0.1")
+        main.rate_store.url = f"{self.base}/v6/latest/{main.PIVOT}"
+        if self.args.workers > 1:
+            elapsed = await self.run_sharded()
+        else:
+            elapsed = await self.run_single()
+        self.fake.close()
+        server.stop()
+        await asyncio.sleep(0.1)
+        self.report(elapsed)
+        if self.args.metrics:
+            print("\n" + main.metrics.render())
+
+    async def run_single(self) -> float:
+        app = main.build_application(TOKEN, base_url=f"{self.base}/bot")
+        await app.initialize()
+        if app.post_init:
+            await app.post_init(app)
+        await app.updater.start_polling(poll_interval=0, timeout=1)
+        await app.start()
+
+        started = time.perf_counter()
+        await self.run_users()
+        elapsed = time.perf_counter() - started
+
+        await app.updater.stop()
+        await app.stop()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        await app.shutdown()
+        return elapsed
+
+    async def run_sharded(self) -> float:
+        """Приёмник в этом процессе, воркеры — отдельные процессы (WORKER_PROCESSES)."""
+        stop = asyncio.Event()
+        receiver = asyncio.create_task(
+            main.run_receiver(TOKEN, self.args.workers, base_url=f"{self.base}/bot", stop_event=stop)
+        )
+        started = time.perf_counter()
+        await self.run_users()
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await receiver
+        return elapsed
+
+    async def run_users(self) -> None:
+        await asyncio.gather(*(self.user(10_000 + i) for i in range(self.args.users)))
+
+    def report(self, elapsed: float) -> None:
+        print(f"\nПользователей: {self.args.users}, апдейтов: {self.updates_sent}, время: {elapsed:.2f} с")
+        print(f"Пропускная способность: {self.updates_sent / elapsed:.1f} апдейтов/с")
+        print(f"Вызовы Bot API: {dict(self.fake.calls)}")
+        print(f"Байт медиа: {dict(self.fake.upload_bytes)}\n")
+        print(f"{'обработчик':<20}{'n':>7}{'ошибок':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'max, мс':>10}")
+        for label in sorted(set(self.latencies) | set(self.failures)):
+            values = sorted(self.latencies[label])
+            row = f"{label:<20}{len(values):>7}{self.failures[label]:>8}"
+            if values:
+                row += "".join(f"{percentile(values, p) * 1000:>10.1f}" for p in (50, 95, 99))
+                row += f"{values[-1] * 1000:>10.1f}"
+            print(row)
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на локальных заглушках.")
+    parser.add_argument("--users", type=int, default=1000, help="число симулированных пользователей")
+    parser.add_argument("--flows-per-user", type=int, default=2, help="сколько сценариев проходит каждый")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument("--api-latency", type=float, default=20, help="задержка заглушки Bot API, мс")
+    parser.add_argument("--rates-latency", type=float, default=150, help="задержка заглушки er-api, мс")
+    parser.add_argument("--video-latency", type=float, default=300, help="задержка видеохостинга, мс")
+    parser.add_argument("--video-size", type=int, default=512, help="размер ролика, КБ")
+    parser.add_argument("--videos", type=int, default=50, help="число разных роликов")
+    parser.add_argument("--mix-calories", type=float, default=4)
+    parser.add_argument("--mix-currency", type=float, default=4)
+    parser.add_argument("--mix-quick-currency", type=float, default=2)
+    parser.add_argument("--mix-feedback", type=float, default=1)
+    parser.add_argument("--mix-video", type=float, default=1)
+    parser.add_argument("--step-timeout", type=float, default=60, help="сколько ждать ответа бота, с")
+    parser.add_argument("--workers", type=int, default=1, help="число процессов-воркеров (больше 1 — многопроцессный режим)")
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--metrics", action="store_true", help="напечатать метрики бота после прогона")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(LoadTest(parse_args()).run())
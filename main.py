@@ -1,25 +1,97 @@
+import asyncio
+import contextlib
+import csv
+import fcntl
+import functools
+import heapq
+import itertools
+import json
 import logging
+import math
+import multiprocessing
 import os
+import queue
+import shutil
+import signal
+import sqlite3
+import sys
 import tempfile
+import threading
+import time
 import traceback
+import httpx
+import numpy as np
 import requests
 import mimetypes
-from io import BytesIO
-from telegram import Update, ReplyKeyboardMarkup, BotCommand
+from bisect import bisect_left
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from cachetools import LRUCache, TTLCache
+from telegram import (
+    Bot,
+    Update,
+    ReplyKeyboardMarkup,
+    BotCommand,
+    InlineQueryResultArticle,
+    InputTextMessageContent
+)
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
+    BaseRateLimiter,
     CommandHandler,
     MessageHandler,
     ContextTypes,
     ConversationHandler,
+    InlineQueryHandler,
+    TypeHandler,
+    Updater,
     filters
 )
-from yt_dlp import YoutubeDL
+
+# Момент загрузки модуля — от него отсчитывается время запуска бота
+STARTED_AT = time.perf_counter()
 
 # Получаем токен и идентификатор админа из переменных окружения (Railway задаёт их через настройки)
 TOKEN = os.environ.get("TOKEN")
 ADMIN_CHAT_ID = os.environ.get("ADMIN_CHAT_ID")
 
+# Режим webhook включается, если задан публичный адрес WEBHOOK_URL; иначе — long polling
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "webhook")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40))
+PORT = int(os.environ.get("PORT", 8443))
+
+# Лимиты исходящих сообщений (в секунду): всего, в личный чат, в группу; запас токенов на чат,
+# число повторов после RetryAfter и на сколько секунд фоновые отправки уступают ответам
+OUTBOUND_GLOBAL_RATE = float(os.environ.get("OUTBOUND_GLOBAL_RATE", 30))
+OUTBOUND_CHAT_RATE = float(os.environ.get("OUTBOUND_CHAT_RATE", 1))
+OUTBOUND_GROUP_RATE = float(os.environ.get("OUTBOUND_GROUP_RATE", 20 / 60))
+OUTBOUND_CHAT_BURST = float(os.environ.get("OUTBOUND_CHAT_BURST", 3))
+OUTBOUND_MAX_RETRIES = int(os.environ.get("OUTBOUND_MAX_RETRIES", 3))
+OUTBOUND_BULK_DELAY = float(os.environ.get("OUTBOUND_BULK_DELAY", 2))
+
+# Число процессов-воркеров: больше 1 — отдельный процесс-приёмник раздаёт апдейты
+# воркерам по chat_id; воркер N отдаёт метрики на METRICS_PORT + 1 + N
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", 1))
+WORKER_SHUTDOWN_TIMEOUT = 30
+
+# Эндпоинт метрик в формате Prometheus (0 — выключен)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+
+# Сколько апдейтов обрабатывается одновременно (апдейты одного чата — всегда по очереди)
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 64))
+# Сколько принятых апдейтов может ждать очереди своего чата (в том числе уже обрабатываемые)
+MAX_PENDING_UPDATES = int(os.environ.get("MAX_PENDING_UPDATES", 10000))
+
+# Через сколько секунд бездействия диалог завершается, а данные пользователя удаляются
+CONVERSATION_TIMEOUT = int(os.environ.get("CONVERSATION_TIMEOUT", 1800))
+
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
@@ -33,14 +105,115 @@ FEEDBACK = 10  # Состояние для отзыва
 
 BACK_TO_MENU = "В меню"
 
+class Session:
+    """Данные пользователя внутри диалога (context.user_data).
+
+    Фиксированный набор слотов вместо словаря на каждого пользователя;
+    незаполненные поля — None.
+    """
+
+    __slots__ = ("height", "weight", "age", "gender", "activity", "currency_from", "currency_to")
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self) -> None:
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    def footprint(self) -> int:
+        """Размер записи в байтах вместе с заполненными полями."""
+        values = (getattr(self, name) for name in self.__slots__)
+        return sys.getsizeof(self) + sum(sys.getsizeof(value) for value in values if value is not None)
+
 # Список валют (добавлены казахский теньге и украинская гривна)
 AVAILABLE_CURRENCIES = [
     "RUB", "UZS", "BYN", "USD", "EUR", "CHF", "TJS", "KGS", "KZT", "UAH"
 ]
 
+# Индексы валют в матрице кросс-курсов
+CURRENCY_INDEX = {cur: i for i, cur in enumerate(AVAILABLE_CURRENCIES)}
+
 # Опорная валюта (pivot)
 PIVOT = "USD"
 
+# Каталог для данных, которые должны переживать перезапуск (снимки курсов и т.п.)
+DATA_DIR = os.environ.get("DATA_DIR", "data")
+
+# Общее хранилище процессов (курсы и file_id медиа) и как часто воркеры перечитывают курсы (сек)
+SHARED_STORE_PATH = os.path.join(DATA_DIR, "shared.sqlite3")
+# Сколько секунд ждать блокировку общего хранилища; запросы идут прямо в цикле событий,
+# поэтому ожидание короткое, а занятая база считается промахом кэша
+SHARED_STORE_TIMEOUT = float(os.environ.get("SHARED_STORE_TIMEOUT", 0.1))
+SHARED_POLL_INTERVAL = 60
+
+# Курсы валют: сколько секунд таблица считается свежей и как часто обновлять её в фоне
+RATES_URL = f"https://open.er-api.com/v6/latest/{PIVOT}"
+RATES_TTL = int(os.environ.get("RATES_TTL", 3600))
+RATES_REFRESH_INTERVAL = int(os.environ.get("RATES_REFRESH_INTERVAL", 1800))
+RATES_SNAPSHOT_PATH = os.path.join(DATA_DIR, "rates.json")
+
+# Загрузка медиа: размер пула, лимиты на пользователя и частота обновления прогресса (сек)
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 4))
+DOWNLOAD_PER_USER_ACTIVE = int(os.environ.get("DOWNLOAD_PER_USER_ACTIVE", 1))
+DOWNLOAD_PER_USER_LIMIT = int(os.environ.get("DOWNLOAD_PER_USER_LIMIT", 3))
+DOWNLOAD_PROGRESS_INTERVAL = 3
+
+# Кэш file_id отправленных медиа: путь, число записей и задержка записи на диск (сек)
+MEDIA_CACHE_PATH = os.path.join(DATA_DIR, "media_cache.json")
+MEDIA_CACHE_SIZE = int(os.environ.get("MEDIA_CACHE_SIZE", 5000))
+MEDIA_CACHE_SAVE_DELAY = 5
+
+# Лимит длины текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Журнал отзывов и как часто отправлять админу накопившиеся отзывы (секунды).
+# Без ADMIN_CHAT_ID отзывы в журнал не пишутся и никуда не отправляются — только в лог
+FEEDBACK_LOG_PATH = os.path.join(DATA_DIR, "feedback.log")
+FEEDBACK_OFFSET_PATH = os.path.join(DATA_DIR, "feedback.offset")
+FEEDBACK_FLUSH_INTERVAL = int(os.environ.get("FEEDBACK_FLUSH_INTERVAL", 600))
+
+# Собственный сервер Bot API (telegram-bot-api --local), например http://telegram-bot-api:8081.
+# Скачанные медиа кладутся в LOCAL_BOT_API_MEDIA_DIR и отправляются путём к файлу, поэтому
+# каталог должен быть смонтирован в контейнер сервера по тому же пути. В обратную сторону то же:
+# get_file отдаёт путь к файлу в рабочем каталоге сервера (--dir), и бот копирует его оттуда, поэтому
+# для CSV-файлов рабочий каталог сервера нужно смонтировать в контейнер бота тоже по тому же пути.
+# Сервер обычно работает под своим пользователем (в Docker-образе — telegram-bot-api), поэтому
+# каталоги загрузок открываются на чтение всем (0755, файлы 0644), а сам LOCAL_BOT_API_MEDIA_DIR
+# должен быть доступен этому пользователю; рабочий каталог сервера — доступен на чтение боту
+LOCAL_BOT_API_URL = os.environ.get("LOCAL_BOT_API_URL")
+LOCAL_BOT_API_MEDIA_DIR = os.path.abspath(os.environ.get("LOCAL_BOT_API_MEDIA_DIR", os.path.join(DATA_DIR, "media")))
+# Каталог для временных файлов скачивания (None — системный)
+MEDIA_WORK_DIR = LOCAL_BOT_API_MEDIA_DIR if LOCAL_BOT_API_URL else None
+
+# Лимит Telegram на загрузку файлов ботом (локальный сервер принимает до 2000 МБ)
+# и параметры потокового скачивания
+TELEGRAM_UPLOAD_LIMIT = (2000 if LOCAL_BOT_API_URL else 50) * 1024 * 1024
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Бюджет на размер ролика при выборе формата yt-dlp и число параллельно скачиваемых фрагментов
+VIDEO_SIZE_BUDGET = min(int(os.environ.get("VIDEO_SIZE_BUDGET", TELEGRAM_UPLOAD_LIMIT)), TELEGRAM_UPLOAD_LIMIT)
+YTDLP_CONCURRENT_FRAGMENTS = int(os.environ.get("YTDLP_CONCURRENT_FRAGMENTS", 4))
+# Экстракторы yt-dlp, которые загружает пул (регулярные выражения по именам, через запятую)
+YTDLP_EXTRACTORS = os.environ.get("YTDLP_EXTRACTORS", "TikTok.*,Instagram.*").split(",")
+# Без ffmpeg нельзя склеить отдельные дорожки видео и звука или сменить контейнер
+FFMPEG_AVAILABLE = shutil.which("ffmpeg") is not None
+# До этого размера скачиваемый файл держится в памяти, дальше — во временном файле на диске
+DOWNLOAD_SPOOL_SIZE = 1024 * 1024
+
+# Inline-режим: сколько секунд Telegram и бот кэшируют ответ на одинаковый запрос
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", 300))
+INLINE_CACHE_SIZE = 10000
+
+# Раскрытие коротких ссылок: время жизни и размер кэша, максимум редиректов
+URL_CACHE_TTL = int(os.environ.get("URL_CACHE_TTL", 24 * 3600))
+URL_CACHE_SIZE = int(os.environ.get("URL_CACHE_SIZE", 10000))
+URL_MAX_REDIRECTS = 5
+
+BROWSER_USER_AGENT = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+    '(KHTML, like Gecko) Chrome/99.0.4844.51 Safari/537.36'
+)
+
 # ---------------- Клавиатуры ----------------
 def main_menu_keyboard():
     return ReplyKeyboardMarkup(
@@ -69,25 +242,461 @@ def currency_keyboard():
     rows.append([BACK_TO_MENU])
     return ReplyKeyboardMarkup(rows, resize_keyboard=True)
 
+# ---------------- Метрики ----------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Timer:
+    """Контекстный менеджер, записывающий длительность блока в гистограмму."""
+
+    __slots__ = ("_metrics", "_key", "_start")
+
+    def __init__(self, metrics, key):
+        self._metrics = metrics
+        self._key = key
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._metrics.observe_key(self._key, time.perf_counter() - self._start)
+
+
+class Metrics:
+    """Минимальный реестр метрик, отдаваемых в текстовом формате Prometheus.
+
+    Запись метрики — это пара операций со словарём и bisect, поэтому
+    инструментирование горячего пути практически ничего не стоит.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._counters = defaultdict(float)
+        # (имя, метки) -> [счётчики по корзинам + +Inf, сумма, количество]
+        self._histograms = {}
+        # имя -> функция, возвращающая текущее значение
+        self._gauges = {}
+        self._server = None
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        self._counters[self._key(name, labels)] += value
+
+    def observe_key(self, key, value: float) -> None:
+        hist = self._histograms.get(key)
+        if hist is None:
+            hist = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        hist[0][bisect_left(self.buckets, value)] += 1
+        hist[1] += value
+        hist[2] += 1
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        self.observe_key(self._key(name, labels), value)
+
+    def timer(self, name: str, **labels) -> Timer:
+        return Timer(self, self._key(name, labels))
+
+    def gauge(self, name: str, func) -> None:
+        self._gauges[name] = func
+
+    @staticmethod
+    def _format_labels(labels, extra=()) -> str:
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for name, labels in sorted(self._counters, key=str):
+            lines.append(f"{name}{self._format_labels(labels)} {self._counters[name, labels]}")
+        for name, func in sorted(self._gauges.items()):
+            try:
+                lines.append(f"{name} {func()}")
+            except Exception as e:
+                logger.error(f"Ошибка при вычислении метрики {name}: {e}")
+        for (name, labels), (counts, total, count) in sorted(self._histograms.items(), key=str):
+            cumulative = 0
+            for bound, bucket in zip(list(self.buckets) + ["+Inf"], counts):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    async def _handle_scrape(self, reader, writer) -> None:
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = self.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                b"Connection: close\r\n\r\n" + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start_server(self, host: str, port: int) -> None:
+        """Поднимает локальный эндпоинт для сбора метрик (любой путь отдаёт метрики)."""
+        self._server = await asyncio.start_server(self._handle_scrape, host, port)
+        logger.info("Метрики доступны на http://%s:%d/metrics", host, port)
+
+    async def stop_server(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+metrics = Metrics()
+
+def track_handler(func):
+    """Считает длительность и ошибки обработчика состояния диалога."""
+    key = Metrics._key("bot_handler_duration_seconds", {"handler": func.__name__})
+
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        with Timer(metrics, key):
+            try:
+                return await func(update, context)
+            except Exception:
+                metrics.inc("bot_handler_errors_total", handler=func.__name__)
+                raise
+    return wrapper
+
 # ---------------- Вспомогательные функции ----------------
 async def check_back_to_menu(text: str, update: Update):
     if text.strip().lower() == BACK_TO_MENU.lower():
-        await update.message.reply_text(
-            "Вы вернулись в главное меню. Что хотите сделать?",
-            reply_markup=main_menu_keyboard()
-        )
+        reply = "Вы вернулись в главное меню. Что хотите сделать?"
+        if download_scheduler.cancel_user(update.effective_user.id):
+            reply = "Загрузка отменена. " + reply
+        await update.message.reply_text(reply, reply_markup=main_menu_keyboard())
         return True
     return False
 
-def expand_url(url: str) -> str:
+_http_client = None
+
+def http_client() -> httpx.AsyncClient:
+    """Общий httpx-клиент: пулы keep-alive соединений по хостам на весь процесс."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            follow_redirects=True,
+            max_redirects=URL_MAX_REDIRECTS,
+            timeout=10,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            headers={"User-Agent": BROWSER_USER_AGENT},
+        )
+    return _http_client
+
+async def close_http_client() -> None:
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+class UrlResolver:
+    """Асинхронно раскрывает короткие ссылки (vm.tiktok.com и т.п.).
+
+    Запросы идут через общий http_client() с keep-alive пулами по хостам
+    и ограниченной цепочкой редиректов, а результаты кэшируются на ttl
+    секунд, поэтому повторные ссылки вообще не идут в сеть.
+    """
+
+    def __init__(self, ttl: int, maxsize: int):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._inflight = {}
+
+    async def _head(self, url: str) -> str:
+        try:
+            with metrics.timer("bot_outbound_duration_seconds", dependency="expand_url"):
+                r = await http_client().head(url)
+        except (httpx.HTTPError, httpx.InvalidURL):
+            metrics.inc("bot_outbound_errors_total", dependency="expand_url")
+            return url
+        resolved = str(r.url)
+        self._cache[url] = resolved
+        return resolved
+
+    async def resolve(self, url: str) -> str:
+        resolved = self._cache.get(url)
+        if resolved is not None:
+            metrics.inc("bot_cache_requests_total", cache="url", result="hit")
+            return resolved
+        metrics.inc("bot_cache_requests_total", cache="url", result="miss")
+        # Одновременные запросы одной ссылки ждут один HEAD-запрос
+        task = self._inflight.get(url)
+        if task is None:
+            task = self._inflight[url] = asyncio.create_task(self._head(url))
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        return await asyncio.shield(task)
+
+url_resolver = UrlResolver(URL_CACHE_TTL, URL_CACHE_SIZE)
+
+async def expand_url(url: str) -> str:
     """Раскрывает короткую ссылку через HEAD-запрос."""
+    return await url_resolver.resolve(url)
+
+def atomic_write_json(path: str, data) -> None:
+    """Записывает JSON во временный файл и атомарно подменяет им целевой."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+        # Данные должны оказаться на диске до подмены, иначе после сбоя хоста файл может быть пустым
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class SharedStore:
+    """Общее для процессов бота хранилище ключ → JSON в SQLite.
+
+    Используется в многопроцессном режиме: приёмник кладёт сюда курсы, а
+    воркеры — file_id отправленных медиа, и все процессы читают их. Режим
+    WAL позволяет читать параллельно с записью. Самые старые записи с
+    заданным префиксом периодически удаляются (см. prune).
+
+    Запросы выполняются синхронно в цикле событий, поэтому блокировку ждём
+    не дольше SHARED_STORE_TIMEOUT: если база занята другим процессом,
+    чтение возвращает None, а запись пропускается.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._writes = 0
+
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=SHARED_STORE_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS kv_updated_at ON kv (updated_at)")
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, sql: str, params=(), many: bool = False):
+        try:
+            conn = self._connection()
+            return (conn.executemany if many else conn.execute)(sql, params)
+        except sqlite3.OperationalError as e:
+            metrics.inc("bot_outbound_errors_total", dependency="shared_store")
+            logger.warning(f"Общее хранилище недоступно: {e}")
+            return None
+
+    def get_json(self, key: str):
+        cursor = self._execute("SELECT value FROM kv WHERE key = ?", (key,))
+        row = None if cursor is None else cursor.fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put_json(self, key: str, value) -> None:
+        self.put_many({key: value})
+
+    def put_many(self, items: dict) -> None:
+        now = time.time()
+        cursor = self._execute(
+            "INSERT OR REPLACE INTO kv (key, value, updated_at) VALUES (?, ?, ?)",
+            [(key, json.dumps(value, ensure_ascii=False), now) for key, value in items.items()],
+            many=True
+        )
+        if cursor is not None:
+            self._writes += len(items)
+
+    def delete(self, key: str) -> None:
+        self._execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def prune(self, prefix: str, keep: int) -> None:
+        """Оставляет не больше keep самых свежих записей с префиксом prefix."""
+        self._execute(
+            "DELETE FROM kv WHERE key IN (SELECT key FROM kv WHERE key LIKE ? "
+            "ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (prefix + "%", keep)
+        )
+
+    def writes(self) -> int:
+        return self._writes
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+shared_store = SharedStore(SHARED_STORE_PATH)
+
+# ---------------- Курсы валют ----------------
+def parse_conversion_query(text: str):
+    """Разбирает запрос вида "250 USD" или "1000 RUB kzt eur".
+
+    Возвращает (сумма, исходная валюта, список целевых валют) или None.
+    Если целевые валюты не указаны, конвертируем во все остальные.
+    """
+    parts = text.replace(",", ".").upper().split()
+    if len(parts) < 2:
+        return None
     try:
-        r = requests.head(url, allow_redirects=True, timeout=10)
-        return r.url
-    except Exception:
-        return url
+        amount = float(parts[0])
+    except ValueError:
+        return None
+    cur_from, targets = parts[1], parts[2:]
+    if cur_from not in CURRENCY_INDEX or any(cur not in CURRENCY_INDEX for cur in targets):
+        return None
+    targets = [cur for cur in dict.fromkeys(targets) if cur != cur_from]
+    if not targets:
+        targets = [cur for cur in AVAILABLE_CURRENCIES if cur != cur_from]
+    return amount, cur_from, targets
+
+def build_cross_rates(rates: dict) -> np.ndarray:
+    """Матрица кросс-курсов AVAILABLE_CURRENCIES × AVAILABLE_CURRENCIES.
+
+    Элемент [i, j] — сколько единиц j-й валюты дают за единицу i-й.
+    Для валют, которых нет в ответе API (или с нулевым курсом), — NaN.
+    """
+    vector = np.array([rates.get(cur) or np.nan for cur in AVAILABLE_CURRENCIES], dtype=float)
+    return vector[np.newaxis, :] / vector[:, np.newaxis]
+
+class RateStore:
+    """Общая на процесс таблица курсов относительно PIVOT.
+
+    Конвертации обслуживаются из памяти. Если таблица устарела, отдаём
+    последнюю известную и обновляем её в фоне (stale-while-revalidate).
+    Последний удачный ответ API хранится на диске, поэтому холодный старт
+    и недоступность API не задерживают пользователя.
+
+    В многопроцессном режиме к API ходит только приёмник и кладёт таблицу
+    в общее хранилище shared, а воркеры (follower=True) читают её оттуда.
+    """
+
+    def __init__(self, url: str, ttl: int, snapshot_path: str):
+        self.url = url
+        self.snapshot_path = snapshot_path
+        # Наличие ключа в TTLCache означает, что таблица ещё свежая
+        self._fresh = TTLCache(maxsize=1, ttl=ttl)
+        self._rates = None
+        self._cross_rates = None
+        self._updated_at = 0.0
+        self._refresh_task = None
+        self._periodic_task = None
+        self.shared = None
+        self.follower = False
+
+    def load_snapshot(self) -> None:
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            self._set_rates(snapshot["rates"], snapshot["updated_at"])
+            logger.info("Курсы валют загружены из снимка %s", self.snapshot_path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Не удалось прочитать снимок курсов: {e}")
+
+    def _set_rates(self, rates: dict, updated_at: float) -> None:
+        # Матрица пересчитывается один раз на обновление, а не на каждый запрос
+        self._cross_rates = build_cross_rates(rates)
+        self._rates = rates
+        self._updated_at = updated_at
+
+    def _fetch(self) -> dict:
+        response = requests.get(self.url, timeout=10)
+        data = response.json()
+        if data.get("result") != "success" or "rates" not in data:
+            raise ValueError("Невалидный ответ API.")
+        return data["rates"]
+
+    def _refresh_from_shared(self) -> None:
+        snapshot = self.shared.get_json("rates")
+        if snapshot is None:
+            raise ValueError("Курсы валют ещё не получены приёмником.")
+        if snapshot["updated_at"] > self._updated_at:
+            self._set_rates(snapshot["rates"], snapshot["updated_at"])
+        self._fresh["rates"] = True
+
+    async def refresh(self) -> None:
+        if self.follower:
+            self._refresh_from_shared()
+            return
+        try:
+            with metrics.timer("bot_outbound_duration_seconds", dependency="er_api"):
+                rates = await asyncio.to_thread(self._fetch)
+        except Exception:
+            metrics.inc("bot_outbound_errors_total", dependency="er_api")
+            raise
+        self._set_rates(rates, time.time())
+        self._fresh["rates"] = True
+        if self.shared is not None:
+            self.shared.put_json("rates", {"rates": rates, "updated_at": self._updated_at})
+        try:
+            await asyncio.to_thread(
+                atomic_write_json, self.snapshot_path,
+                {"rates": rates, "updated_at": self._updated_at}
+            )
+        except OSError as e:
+            logger.error(f"Не удалось сохранить снимок курсов: {e}")
+
+    def _refresh_in_background(self) -> None:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._safe_refresh())
+
+    async def _safe_refresh(self) -> None:
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.error(f"Ошибка при обновлении курсов валют: {e}")
+
+    async def get_rates(self) -> dict:
+        """Возвращает таблицу курсов, обращаясь к API только при пустом кэше."""
+        if self._rates is None:
+            metrics.inc("bot_cache_requests_total", cache="rates", result="miss")
+            self._refresh_in_background()
+            await asyncio.shield(self._refresh_task)
+            if self._rates is None:
+                raise ValueError("Курсы валют недоступны.")
+        elif "rates" not in self._fresh:
+            metrics.inc("bot_cache_requests_total", cache="rates", result="stale")
+            self._refresh_in_background()
+        else:
+            metrics.inc("bot_cache_requests_total", cache="rates", result="hit")
+        return self._rates
+
+    async def get_cross_rates(self) -> np.ndarray:
+        """Возвращает матрицу кросс-курсов (см. build_cross_rates)."""
+        await self.get_rates()
+        return self._cross_rates
+
+    def age(self) -> float:
+        """Сколько секунд прошло с последнего удачного обновления курсов."""
+        return time.time() - self._updated_at if self._updated_at else 0.0
+
+    async def _run_periodic(self, interval: int) -> None:
+        while True:
+            self._refresh_in_background()
+            await asyncio.shield(self._refresh_task)
+            await asyncio.sleep(interval)
+
+    def start(self, interval: int) -> None:
+        self.load_snapshot()
+        self._periodic_task = asyncio.create_task(self._run_periodic(interval))
+
+    async def stop(self) -> None:
+        for task in (self._periodic_task, self._refresh_task):
+            if task is not None and not task.done():
+                task.cancel()
+
+rate_store = RateStore(RATES_URL, RATES_TTL, RATES_SNAPSHOT_PATH)
+metrics.gauge("bot_rates_age_seconds", rate_store.age)
 
 # ---------------- Команды /start и /cancel ----------------
+@track_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     await update.message.reply_text(
@@ -96,11 +705,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return MENU
 
+@track_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    download_scheduler.cancel_user(update.effective_user.id)
+    context.application.drop_user_data(update.effective_user.id)
     await update.message.reply_text("Диалог отменён. Введите /start, чтобы начать заново.")
     return ConversationHandler.END
 
+@track_handler
+async def conversation_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Диалог простоял CONVERSATION_TIMEOUT секунд: состояние и данные пользователя удаляются.
+
+    Следующее сообщение подхватит точка входа в главное меню, так что для
+    пользователя это возврат в MENU.
+    """
+    if update.effective_user is not None:
+        context.application.drop_user_data(update.effective_user.id)
+    metrics.inc("bot_sessions_expired_total")
+
 # ---------------- Главное меню ----------------
+@track_handler
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip().lower()
     if "калори" in text:
@@ -119,8 +743,9 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         info_text = (
             "Это бот, который умеет:\n"
             "• Рассчитывать норму калорий на основе введённых параметров (рост, вес, возраст, пол, уровень активности).\n"
+            "• Считать калории для целого списка — пришлите CSV-файл с колонками height, weight, age, gender, activity.\n"
             "• Загружать видео с TikTok и Instagram.\n"
-            "• Конвертировать валюты.\n\n"
+            "• Конвертировать валюты — можно одним сообщением, например: 250 USD или 1000 RUB KZT EUR.\n\n"
             "Разработчик – AlexProd.\n"
             "Спасибо, что используете бота!"
         )
@@ -128,7 +753,8 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return MENU
     elif "валют" in text or "конвер" in text:
         await update.message.reply_text(
-            "Выберите валюту, из которой конвертируем:",
+            "Выберите валюту, из которой конвертируем.\n"
+            "Или напишите всё сразу, например: 250 USD или 1000 RUB KZT EUR",
             reply_markup=currency_keyboard()
         )
         return CURRENCY_FROM
@@ -138,6 +764,9 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=ReplyKeyboardMarkup([[BACK_TO_MENU]], resize_keyboard=True)
         )
         return FEEDBACK
+    elif (query := parse_conversion_query(text)) is not None:
+        await reply_quick_conversion(update, query)
+        return MENU
     else:
         await update.message.reply_text(
             "Пожалуйста, выберите действие из меню.",
@@ -146,6 +775,172 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return MENU
 
 # ---------------- Раздел отзывов ----------------
+class FeedbackLog:
+    """Журнал отзывов с отложенной пакетной отправкой админу.
+
+    Отзыв дописывается строкой JSON в конец файла — на пути пользователя нет
+    сетевых запросов. Периодический flush собирает неотправленные записи в
+    дайджесты не длиннее лимита сообщения Telegram и после каждой успешной
+    отправки сохраняет смещение уже доставленной части. Если отправка не
+    удалась, отзывы остаются в журнале до следующей попытки. Когда всё
+    доставлено, журнал обнуляется.
+
+    В журнал могут писать несколько процессов: каждая запись — один write
+    в файл, открытый на дозапись, а запись и обнуление журнала разделены
+    блокировкой flock. Отправляет дайджесты только один процесс.
+    """
+
+    def __init__(self, path: str, offset_path: str):
+        self.path = path
+        self.offset_path = offset_path
+        self._fd = None
+        self._lock = asyncio.Lock()
+        self._periodic_task = None
+        # Число недоставленных записей
+        self.pending = 0
+
+    def _open(self) -> int:
+        if self._fd is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        return self._fd
+
+    def append(self, entry: dict) -> None:
+        fd = self._open()
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            os.write(fd, line)
+            # Пользователю уже ответят «спасибо» — отзыв должен пережить и падение хоста
+            os.fsync(fd)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self.pending += 1
+
+    def _load_offset(self) -> int:
+        try:
+            with open(self.offset_path, encoding="utf-8") as f:
+                return json.load(f)["offset"]
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            logger.error(f"Не удалось прочитать смещение журнала отзывов: {e}")
+            return 0
+
+    def _read_pending(self):
+        """Возвращает [(смещение конца записи, запись)] после последней доставленной."""
+        offset = self._load_offset()
+        pending = []
+        try:
+            with open(self.path, "rb") as f:
+                # Журнал удалили или обнулили вручную — читаем с начала
+                if os.fstat(f.fileno()).st_size < offset:
+                    offset = 0
+                f.seek(offset)
+                for line in f:
+                    offset += len(line)
+                    # Недописанная строка (запись прервана) будет прочитана в следующий раз
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        pending.append((offset, json.loads(line)))
+                    except ValueError:
+                        logger.error(f"Повреждённая запись в журнале отзывов: {line!r}")
+        except FileNotFoundError:
+            pass
+        return pending
+
+    def _compact(self, offset: int) -> None:
+        # Под блокировкой ни один процесс не допишет запись между проверкой и усечением.
+        # Смещение обнуляется первым: сбой посередине приведёт к повтору, а не к потере отзывов
+        fd = self._open()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size != offset:
+                return
+            atomic_write_json(self.offset_path, {"offset": 0})
+            os.ftruncate(fd, 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+    @staticmethod
+    def format_entry(entry: dict) -> str:
+        return (
+            f"Отзыв от {entry['first_name']} (ID: {entry['user_id']}, username: {entry['username']}, "
+            f"{time.strftime('%d.%m %H:%M', time.localtime(entry['ts']))}):\n{entry['text']}"
+        )
+
+    @staticmethod
+    def build_digests(pending, limit: int = TELEGRAM_MESSAGE_LIMIT):
+        """Разбивает записи на сообщения не длиннее limit: [(смещение, текст)].
+
+        Смещение дайджеста — конец последней записи, целиком вошедшей в него;
+        слишком длинная запись режется на несколько сообщений.
+        """
+        digests = []
+        parts, size, last_offset = [], 0, None
+        for offset, entry in pending:
+            text = FeedbackLog.format_entry(entry)
+            pieces = [text[i:i + limit] for i in range(0, len(text), limit)]
+            for i, piece in enumerate(pieces):
+                if parts and size + len(piece) + 2 > limit:
+                    digests.append((last_offset, "\n\n".join(parts)))
+                    parts, size = [], 0
+                parts.append(piece)
+                size += len(piece) + 2
+                # До последнего куска запись не считается доставленной
+                last_offset = offset if i == len(pieces) - 1 else last_offset
+        if parts:
+            digests.append((last_offset, "\n\n".join(parts)))
+        return digests
+
+    async def flush(self, bot, chat_id) -> int:
+        """Отправляет накопленные отзывы в chat_id, возвращает число доставленных."""
+        async with self._lock:
+            pending = await asyncio.to_thread(self._read_pending)
+            if not pending:
+                return 0
+            delivered = 0
+            offsets = [offset for offset, _ in pending]
+            for offset, text in self.build_digests(pending):
+                try:
+                    with metrics.timer("bot_outbound_duration_seconds", dependency="telegram_admin"):
+                        await bot.send_message(chat_id=chat_id, text=text, rate_limit_args=PRIORITY_BULK)
+                except TelegramError as e:
+                    logger.error(f"Ошибка при отправке дайджеста отзывов: {e}")
+                    break
+                if offset is not None:
+                    atomic_write_json(self.offset_path, {"offset": offset})
+                    delivered = offsets.index(offset) + 1
+            self.pending = max(0, self.pending - delivered)
+            metrics.inc("bot_feedback_delivered_total", delivered)
+            if delivered == len(pending):
+                self._compact(offsets[-1])
+            return delivered
+
+    async def _run_periodic(self, bot, chat_id, interval: int) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush(bot, chat_id)
+            except Exception as e:
+                logger.error(f"Ошибка при сбросе журнала отзывов: {e}")
+
+    def start(self, bot, chat_id, interval: int) -> None:
+        self.pending = len(self._read_pending())
+        self._periodic_task = asyncio.create_task(self._run_periodic(bot, chat_id, interval))
+
+    async def stop(self) -> None:
+        if self._periodic_task is not None and not self._periodic_task.done():
+            self._periodic_task.cancel()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+feedback_log = FeedbackLog(FEEDBACK_LOG_PATH, FEEDBACK_OFFSET_PATH)
+metrics.gauge("bot_feedback_pending", lambda: feedback_log.pending)
+
+@track_handler
 async def feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     if await check_back_to_menu(text, update):
@@ -154,31 +949,255 @@ async def feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     feedback_message = (
         f"Отзыв от {user.first_name} (ID: {user.id}, username: {user.username}):\n{text}"
     )
-    try:
-        if ADMIN_CHAT_ID:
-            await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=feedback_message)
-        else:
-            logger.info("ADMIN_CHAT_ID не задан. Отзыв:\n" + feedback_message)
-    except Exception as e:
-        logger.error(f"Ошибка при отправке отзыва: {e}")
+    if not ADMIN_CHAT_ID:
+        # Дайджесты отправлять некому — журнал копился бы бесконечно
+        logger.info("ADMIN_CHAT_ID не задан. Отзыв:\n" + feedback_message)
+    else:
+        try:
+            feedback_log.append({
+                "ts": time.time(),
+                "user_id": user.id,
+                "first_name": user.first_name,
+                "username": user.username,
+                "text": text,
+            })
+        except OSError as e:
+            logger.error(f"Не удалось записать отзыв в журнал: {e}")
+            logger.info(feedback_message)
+    metrics.inc("bot_feedback_total")
     await update.message.reply_text(
         "Спасибо за ваш отзыв!",
         reply_markup=main_menu_keyboard()
     )
     return MENU
 
+@track_handler
+async def feedback_digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /reviews: админ забирает накопленные отзывы, не дожидаясь периодической отправки."""
+    if not ADMIN_CHAT_ID or str(update.effective_chat.id) != str(ADMIN_CHAT_ID):
+        return
+    delivered = await feedback_log.flush(context.bot, ADMIN_CHAT_ID)
+    if not delivered:
+        await update.message.reply_text("Новых отзывов нет.")
+
 # ---------------- Функции расчёта калорий, скачивания видео и конвертации валют ----------------
-# Функции get_height, get_weight, get_age, get_gender, get_activity,
-# video_by_link и функции для конвертации валют остаются без изменений,
-# они используют AVAILABLE_CURRENCIES для формирования клавиатуры и конвертации.
 
+# Уровни активности (1-5) и их коэффициенты
+ACTIVITY_LEVELS = {"1": 1.2, "2": 1.375, "3": 1.55, "4": 1.725, "5": 1.9}
+
+GENDER_ALIASES = {
+    "м": "Мужчина", "муж": "Мужчина", "мужчина": "Мужчина", "m": "Мужчина", "male": "Мужчина",
+    "ж": "Женщина", "жен": "Женщина", "женщина": "Женщина", "f": "Женщина", "w": "Женщина", "female": "Женщина",
+}
+
+# Категории ИМТ и множители к TDEE для рекомендуемой калорийности
+BMI_CATEGORIES = ("недостаток", "норма", "избыточный", "ожирение")
+BMI_CALORIE_FACTORS = np.array([1.15, 1.0, 0.85, 0.8])
+INTENSIVE_CALORIE_FACTOR = 0.75
+
+def _round_like_python(values: np.ndarray, digits: int) -> np.ndarray:
+    """np.round, но почти-половинные значения округляются встроенным round().
+
+    np.round масштабирует число перед округлением и на таких значениях
+    иногда расходится с round(), а от ИМТ зависит категория.
+    """
+    rounded = np.round(values, digits)
+    scaled = values * 10 ** digits
+    for i in np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6):
+        rounded[i] = round(float(values[i]), digits)
+    return rounded
+
+def calorie_engine(height, weight, age, is_male, activity) -> dict:
+    """Векторный расчёт ИМТ, BMR (Миффлин — Сан Жеор) и TDEE.
+
+    Принимает массивы одинаковой длины (рост в см, вес в кг, возраст, признак
+    мужского пола, коэффициент активности) и возвращает словарь массивов:
+    imt, bmr, tdee, category (индекс в BMI_CATEGORIES), recommended и
+    intensive (калорийность для усиленного похудения, только при ожирении).
+    """
+    height = np.asarray(height, dtype=float)
+    weight = np.asarray(weight, dtype=float)
+    age = np.asarray(age, dtype=float)
+    activity = np.asarray(activity, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        imt = _round_like_python(weight / (height / 100) ** 2, 2)
+    # Тот же порядок операций, что и в исходной формуле, чтобы округление совпадало
+    bmr = np.round((10 * weight) + (6.25 * height - 5 * age + np.where(is_male, 5, -161)))
+    tdee = np.round(bmr * activity)
+    category = np.select(
+        [imt < 18.5, (imt >= 18.5) & (imt <= 24.9), (imt >= 25) & (imt <= 29.9)],
+        [0, 1, 2],
+        default=3
+    )
+    return {
+        "imt": imt,
+        "bmr": bmr,
+        "tdee": tdee,
+        "category": category,
+        "recommended": np.round(tdee * BMI_CALORIE_FACTORS[category]),
+        "intensive": np.where(category == 3, np.round(tdee * INTENSIVE_CALORIE_FACTOR), np.nan),
+    }
+
+def calorie_recommendation(height: float, weight: float, age: float, gender: str, activity: float) -> str:
+    """Считает ИМТ и суточную норму через calorie_engine и формирует рекомендацию."""
+    result = calorie_engine([height], [weight], [age], [gender == "Мужчина"], [activity])
+    imt = float(result["imt"][0])
+    category = int(result["category"][0])
+    recommended = int(result["recommended"][0])
+    if category == 0:
+        return f"Ваш ИМТ: {imt} (недостаток). Рекомендуемая калорийность: {recommended} ккал."
+    elif category == 1:
+        return f"Ваш ИМТ: {imt} (норма). Для поддержания веса: {recommended} ккал."
+    elif category == 2:
+        return f"Ваш ИМТ: {imt} (избыточный). Рекомендуемая калорийность: {recommended} ккал."
+    else:
+        intensive = int(result["intensive"][0])
+        return f"Ваш ИМТ: {imt} (ожирение). Рекомендуемая калорийность: {recommended} ккал или {intensive} ккал для усиленного похудения."
+
+# ---------------- Массовый расчёт калорий из CSV ----------------
+CSV_COLUMNS = ("height", "weight", "age", "gender", "activity")
+CSV_RESULT_COLUMNS = ("bmi", "bmr", "tdee", "category", "recommended_kcal", "intensive_kcal", "error")
+CSV_CHUNK_ROWS = 10000
+# Облачный Bot API позволяет ботам скачивать файлы не больше 20 МБ, локальный — без ограничения
+TELEGRAM_DOWNLOAD_LIMIT = TELEGRAM_UPLOAD_LIMIT if LOCAL_BOT_API_URL else 20 * 1024 * 1024
+
+def _parse_activity(value: str) -> float:
+    if value in ACTIVITY_LEVELS:
+        return ACTIVITY_LEVELS[value]
+    coefficient = float(value)
+    if coefficient not in ACTIVITY_LEVELS.values():
+        raise ValueError(value)
+    return coefficient
+
+def _process_csv_chunk(rows: list, columns: list, writer) -> int:
+    """Считает одну пачку строк через calorie_engine, пишет результат и возвращает число ошибок."""
+    n = len(rows)
+    values = np.full((n, 4), np.nan)
+    is_male = np.zeros(n, dtype=bool)
+    valid = np.ones(n, dtype=bool)
+    for i, row in enumerate(rows):
+        try:
+            height, weight, age, gender, activity = (row[c].strip() for c in columns)
+            values[i] = (
+                float(height.replace(",", ".")),
+                float(weight.replace(",", ".")),
+                float(age.replace(",", ".")),
+                _parse_activity(activity.replace(",", ".")),
+            )
+            is_male[i] = GENDER_ALIASES[gender.lower()] == "Мужчина"
+            # nan/inf и неположительные рост, вес или возраст считаем ошибкой строки
+            if not (np.isfinite(values[i]).all() and (values[i, :3] > 0).all()):
+                raise ValueError(row)
+        except (IndexError, ValueError, KeyError):
+            values[i] = np.nan
+            valid[i] = False
+    result = calorie_engine(values[:, 0], values[:, 1], values[:, 2], is_male, values[:, 3])
+    columns_out = zip(
+        result["imt"].tolist(),
+        result["bmr"].tolist(),
+        result["tdee"].tolist(),
+        result["category"].tolist(),
+        result["recommended"].tolist(),
+        result["intensive"].tolist(),
+    )
+    for row, ok, (imt, bmr, tdee, category, recommended, intensive) in zip(rows, valid.tolist(), columns_out):
+        if ok:
+            writer.writerow(row + [
+                imt, int(bmr), int(tdee), BMI_CATEGORIES[category], int(recommended),
+                "" if math.isnan(intensive) else int(intensive), ""
+            ])
+        else:
+            writer.writerow(row + ["", "", "", "", "", "", "некорректные данные"])
+    return n - int(valid.sum())
+
+def process_calorie_csv(in_path: str, out_path: str):
+    """Потоково считает калории для CSV-файла пачками по CSV_CHUNK_ROWS строк.
+
+    Колонки ищутся по заголовку (height, weight, age, gender, activity), без
+    заголовка берутся первые пять по порядку. Разделитель (",", ";" или
+    табуляция) определяется автоматически и сохраняется в файле результата.
+    Возвращает (число строк, число строк с ошибками).
+    """
+    rows_total = errors = 0
+    with open(in_path, newline="", encoding="utf-8-sig") as src, \
+            open(out_path, "w", newline="", encoding="utf-8") as dst:
+        sample = src.read(4096)
+        src.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.reader(src, dialect)
+        writer = csv.writer(dst, dialect)
+        first = next(reader, None)
+        if first is None:
+            return 0, 0
+        header = [cell.strip().lower() for cell in first]
+        if all(name in header for name in CSV_COLUMNS):
+            columns = [header.index(name) for name in CSV_COLUMNS]
+            writer.writerow(first + list(CSV_RESULT_COLUMNS))
+            chunk = []
+        else:
+            columns = list(range(len(CSV_COLUMNS)))
+            writer.writerow(list(CSV_COLUMNS) + list(CSV_RESULT_COLUMNS))
+            chunk = [first]
+        for row in reader:
+            if not row:
+                continue
+            chunk.append(row)
+            if len(chunk) >= CSV_CHUNK_ROWS:
+                errors += _process_csv_chunk(chunk, columns, writer)
+                rows_total += len(chunk)
+                chunk = []
+        if chunk:
+            errors += _process_csv_chunk(chunk, columns, writer)
+            rows_total += len(chunk)
+    return rows_total, errors
+
+@track_handler
+async def bulk_calories(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    document = update.message.document
+    if document.file_size and document.file_size > TELEGRAM_DOWNLOAD_LIMIT:
+        await update.message.reply_text(
+            f"Файл слишком большой: Telegram позволяет боту скачивать файлы до {TELEGRAM_DOWNLOAD_LIMIT // (1024 * 1024)} МБ."
+        )
+        return
+    await update.message.reply_text("Считаю калории для файла, пожалуйста, подождите...")
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        in_path = os.path.join(tmpdirname, "input.csv")
+        out_path = os.path.join(tmpdirname, "calories.csv")
+        try:
+            telegram_file = await document.get_file()
+            # С локальным сервером Bot API это копирование из его рабочего каталога
+            await telegram_file.download_to_drive(in_path)
+            rows, errors = await asyncio.to_thread(process_calorie_csv, in_path, out_path)
+        except TelegramError as e:
+            logger.error(f"Ошибка при скачивании CSV: {e}")
+            await update.message.reply_text(
+                "Не удалось получить файл от Telegram. Попробуйте отправить его ещё раз позже."
+            )
+            return
+        except (UnicodeDecodeError, csv.Error, ValueError, OSError) as e:
+            logger.error(f"Ошибка при чтении CSV: {e}")
+            await update.message.reply_text(
+                "Не удалось прочитать файл. Нужен CSV в UTF-8 с колонками height, weight, age, gender, activity."
+            )
+            return
+        with open(out_path, "rb") as result_file:
+            await update.message.reply_document(
+                document=result_file,
+                filename="calories.csv",
+                caption=f"Готово! Обработано строк: {rows}, с ошибками: {errors}."
+            )
+
+@track_handler
 async def get_height(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     if await check_back_to_menu(text, update):
         return MENU
     try:
         height = float(text)
-        context.user_data["height"] = height
+        context.user_data.height = height
         await update.message.reply_text(
             "Теперь введите свой вес в кг:",
             reply_markup=ReplyKeyboardMarkup([[BACK_TO_MENU]], resize_keyboard=True)
@@ -188,13 +1207,14 @@ async def get_height(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Пожалуйста, введите корректное числовое значение для роста.")
         return HEIGHT
 
+@track_handler
 async def get_weight(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     if await check_back_to_menu(text, update):
         return MENU
     try:
         weight = float(text)
-        context.user_data["weight"] = weight
+        context.user_data.weight = weight
         await update.message.reply_text(
             "Введите свой возраст:",
             reply_markup=ReplyKeyboardMarkup([[BACK_TO_MENU]], resize_keyboard=True)
@@ -204,13 +1224,14 @@ async def get_weight(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Пожалуйста, введите корректное числовое значение для веса.")
         return WEIGHT
 
+@track_handler
 async def get_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     if await check_back_to_menu(text, update):
         return MENU
     try:
         age = float(text)
-        context.user_data["age"] = age
+        context.user_data.age = age
         keyboard = [["Мужчина", "Женщина"], [BACK_TO_MENU]]
         await update.message.reply_text("Укажите ваш пол:", reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
         return GENDER
@@ -218,6 +1239,7 @@ async def get_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Пожалуйста, введите корректное числовое значение для возраста.")
         return AGE
 
+@track_handler
 async def get_gender(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     if await check_back_to_menu(text, update):
@@ -228,7 +1250,7 @@ async def get_gender(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=ReplyKeyboardMarkup([["Мужчина", "Женщина"], [BACK_TO_MENU]], resize_keyboard=True)
         )
         return GENDER
-    context.user_data["gender"] = text.title()
+    context.user_data.gender = text.title()
     keyboard = [["1", "2"], ["3", "4"], ["5"], [BACK_TO_MENU]]
     message = (
         "Выберите уровень активности (1-5):\n"
@@ -241,62 +1263,53 @@ async def get_gender(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(message, reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True))
     return ACTIVITY
 
+@track_handler
 async def get_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     if await check_back_to_menu(text, update):
         return MENU
-    activity_mapping = {"1": 1.2, "2": 1.375, "3": 1.55, "4": 1.725, "5": 1.9}
-    if text not in activity_mapping:
+    if text not in ACTIVITY_LEVELS:
         await update.message.reply_text("Пожалуйста, выберите цифру от 1 до 5 или нажмите 'В меню'.")
         return ACTIVITY
-    context.user_data["activity"] = activity_mapping[text]
-    try:
-        height = context.user_data["height"]
-        weight = context.user_data["weight"]
-        age = context.user_data["age"]
-        gender = context.user_data["gender"]
-        activity = context.user_data["activity"]
-    except KeyError:
+    context.user_data.activity = ACTIVITY_LEVELS[text]
+    session = context.user_data
+    height, weight, age, gender, activity = (
+        session.height, session.weight, session.age, session.gender, session.activity
+    )
+    if None in (height, weight, age, gender):
+        context.application.drop_user_data(update.effective_user.id)
         await update.message.reply_text("Данные введены не полностью. Попробуйте заново командой /start.")
         return ConversationHandler.END
-    height_m = height / 100
-    imt = round(weight / (height_m ** 2), 2)
-    if gender == "Мужчина":
-        bmr = round((10 * weight) + (6.25 * height - 5 * age + 5))
-    else:
-        bmr = round((10 * weight) + (6.25 * height - 5 * age - 161))
-    tdee = round(bmr * activity)
-    if imt < 18.5:
-        rec = f"Ваш ИМТ: {imt} (недостаток). Рекомендуемая калорийность: {round(tdee * 1.15)} ккал."
-    elif 18.5 <= imt <= 24.9:
-        rec = f"Ваш ИМТ: {imt} (норма). Для поддержания веса: {tdee} ккал."
-    elif 25 <= imt <= 29.9:
-        rec = f"Ваш ИМТ: {imt} (избыточный). Рекомендуемая калорийность: {round(tdee * 0.85)} ккал."
-    else:
-        rec = f"Ваш ИМТ: {imt} (ожирение). Рекомендуемая калорийность: {round(tdee * 0.8)} ккал или {round(tdee * 0.75)} ккал для усиленного похудения."
+    rec = calorie_recommendation(height, weight, age, gender, activity)
     await update.message.reply_text(
         f"{rec}\n\nСпасибо за использование бота!",
         reply_markup=ReplyKeyboardMarkup([[BACK_TO_MENU]], resize_keyboard=True)
     )
     return MENU
 
+@track_handler
 async def currency_from(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip().upper()
     if await check_back_to_menu(text, update):
         return MENU
     if text not in AVAILABLE_CURRENCIES:
+        query = parse_conversion_query(text)
+        if query is not None:
+            await reply_quick_conversion(update, query)
+            return CURRENCY_FROM
         await update.message.reply_text(
             "Пожалуйста, выберите одну из доступных валют или нажмите 'В меню'.",
             reply_markup=currency_keyboard()
         )
         return CURRENCY_FROM
-    context.user_data["currency_from"] = text
+    context.user_data.currency_from = text
     await update.message.reply_text(
         f"Исходная валюта: {text}\nТеперь выберите валюту, в которую переводим:",
         reply_markup=currency_keyboard()
     )
     return CURRENCY_TO
 
+@track_handler
 async def currency_to(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip().upper()
     if await check_back_to_menu(text, update):
@@ -307,13 +1320,14 @@ async def currency_to(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=currency_keyboard()
         )
         return CURRENCY_TO
-    context.user_data["currency_to"] = text
+    context.user_data.currency_to = text
     await update.message.reply_text(
         f"Целевая валюта: {text}\nВведите сумму, которую нужно конвертировать:",
         reply_markup=ReplyKeyboardMarkup([[BACK_TO_MENU]], resize_keyboard=True)
     )
     return CURRENCY_AMOUNT
 
+@track_handler
 async def currency_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     if await check_back_to_menu(text, update):
@@ -323,23 +1337,14 @@ async def currency_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("Пожалуйста, введите числовое значение суммы.")
         return CURRENCY_AMOUNT
-    cur_from = context.user_data["currency_from"]
-    cur_to = context.user_data["currency_to"]
-    url = f"https://open.er-api.com/v6/latest/{PIVOT}"
+    cur_from = context.user_data.currency_from
+    cur_to = context.user_data.currency_to
     try:
-        response = requests.get(url, timeout=10)
-        data = response.json()
-        if data.get("result") != "success" or "rates" not in data:
-            raise ValueError("Невалидный ответ API.")
-        rates = data["rates"]
-        if cur_from not in rates or cur_to not in rates:
+        cross_rates = await rate_store.get_cross_rates()
+        rate_final = cross_rates[CURRENCY_INDEX[cur_from], CURRENCY_INDEX[cur_to]]
+        if not np.isfinite(rate_final):
             raise ValueError("Одна из валют не поддерживается API.")
-        rate_from = rates[cur_from]
-        rate_to = rates[cur_to]
-        if rate_from == 0:
-            raise ZeroDivisionError("Курс для исходной валюты равен 0.")
-        rate_final = rate_to / rate_from
-        result = round(rate_final * amount, 2)
+        result = round(float(rate_final * amount), 2)
         message = (
             f"{amount} {cur_from} = {result} {cur_to}\n\n"
             "Хотите выбрать другие валюты или вернуться в меню?"
@@ -352,6 +1357,687 @@ async def currency_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return MENU
     return CURRENCY_AMOUNT
 
+async def convert_query(query) -> str:
+    """Формирует ответ на запрос из parse_conversion_query."""
+    amount, cur_from, targets = query
+    cross_rates = await rate_store.get_cross_rates()
+    row = cross_rates[CURRENCY_INDEX[cur_from]]
+    results = np.round(row[[CURRENCY_INDEX[cur] for cur in targets]] * amount, 2)
+    lines = [f"{result} {cur}" for cur, result in zip(targets, results.tolist()) if np.isfinite(result)]
+    if not lines:
+        return "Эти валюты сейчас не поддерживаются API."
+    return f"{amount} {cur_from} =\n" + "\n".join(lines)
+
+async def reply_quick_conversion(update: Update, query) -> None:
+    """Отвечает одним сообщением на запрос из parse_conversion_query."""
+    try:
+        text = await convert_query(query)
+    except Exception as e:
+        logger.error(f"Ошибка при конвертации валют: {e}")
+        await update.message.reply_text("Ошибка при получении курса валют. Попробуйте позже.")
+        return
+    await update.message.reply_text(text)
+
+# ---------------- Inline-режим ----------------
+# Inline-режим нужно включить у бота через @BotFather (/setinline)
+def parse_calorie_query(text: str):
+    """Разбирает запрос вида "180 75 30 м 3" (рост, вес, возраст, пол, активность)."""
+    parts = text.lower().replace(",", ".").split()
+    if len(parts) != 5 or parts[3] not in GENDER_ALIASES or parts[4] not in ACTIVITY_LEVELS:
+        return None
+    try:
+        height, weight, age = (float(p) for p in parts[:3])
+    except ValueError:
+        return None
+    if height <= 0:
+        return None
+    return height, weight, age, GENDER_ALIASES[parts[3]], ACTIVITY_LEVELS[parts[4]]
+
+def inline_article(result_id: str, title: str, text: str) -> InlineQueryResultArticle:
+    return InlineQueryResultArticle(
+        id=result_id,
+        title=title,
+        description=text.splitlines()[0],
+        input_message_content=InputTextMessageContent(text),
+    )
+
+INLINE_HELP = inline_article(
+    "help",
+    "Калории или валюта",
+    "Напишите, например:\n"
+    "• 180 75 30 м 3 — рост, вес, возраст, пол (м/ж) и активность (1-5)\n"
+    "• 100 USD RUB — конвертация валют (без целевой валюты — во все доступные)"
+)
+
+async def build_inline_results(query: str) -> list:
+    calories = parse_calorie_query(query)
+    if calories is not None:
+        return [inline_article("calories", "Норма калорий", calorie_recommendation(*calories))]
+    conversion = parse_conversion_query(query)
+    if conversion is not None:
+        text = await convert_query(conversion)
+        return [inline_article("currency", f"Конвертация из {conversion[1]}", text)]
+    return [INLINE_HELP]
+
+@track_handler
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = " ".join(update.inline_query.query.lower().split())
+    results = inline_cache.get(query)
+    if results is None:
+        metrics.inc("bot_cache_requests_total", cache="inline", result="miss")
+        try:
+            results = await build_inline_results(query)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке inline-запроса: {e}")
+            await update.inline_query.answer([], cache_time=0)
+            return
+        inline_cache[query] = results
+    else:
+        metrics.inc("bot_cache_requests_total", cache="inline", result="hit")
+    await update.inline_query.answer(results, cache_time=INLINE_CACHE_TIME)
+
+inline_cache = TTLCache(maxsize=INLINE_CACHE_SIZE, ttl=INLINE_CACHE_TIME)
+
+# ---------------- Очередь загрузок медиа ----------------
+class JobCancelled(Exception):
+    """Поднимается из progress-хука yt-dlp, чтобы прервать отменённую загрузку."""
+
+
+class DownloadJob:
+    """Одна заявка пользователя на скачивание медиа по ссылке."""
+
+    def __init__(self, user_id: int, message, url: str):
+        self.user_id = user_id
+        self.message = message
+        self.url = url
+        self.status_message = None
+        self.task = None
+        self.cancelled = threading.Event()
+        self.loop = asyncio.get_running_loop()
+        self.created_at = time.perf_counter()
+        self._last_progress = 0.0
+
+    async def set_status(self, text: str) -> None:
+        if self.status_message is None:
+            return
+        try:
+            await self.status_message.edit_text(text)
+        except TelegramError:
+            # Например, "message is not modified" — прогресс не критичен
+            pass
+
+    def progress_hook(self, d: dict) -> None:
+        """Progress-хук yt-dlp; вызывается из рабочего потока."""
+        if self.cancelled.is_set():
+            raise JobCancelled()
+        if d.get("status") != "downloading":
+            return
+        total = d.get("total_bytes") or d.get("total_bytes_estimate")
+        now = time.monotonic()
+        if not total or now - self._last_progress < DOWNLOAD_PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        percent = int(d.get("downloaded_bytes", 0) * 100 / total)
+        asyncio.run_coroutine_threadsafe(
+            self.set_status(f"Скачиваю медиа: {percent}%"), self.loop
+        )
+
+
+class DownloadScheduler:
+    """Ограниченный пул загрузчиков со справедливой очередью по пользователям.
+
+    Задачи выбираются по кругу (round-robin) между пользователями, у каждого
+    пользователя одновременно выполняется не больше per_user_active задач.
+    Блокирующая работа (yt-dlp, requests) выполняется в пуле потоков, поэтому
+    остальные обработчики бота не ждут загрузок.
+    """
+
+    def __init__(self, workers: int, per_user_active: int, per_user_limit: int):
+        self.workers = workers
+        self.per_user_active = per_user_active
+        self.per_user_limit = per_user_limit
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+        self._pending = {}
+        self._running = {}
+        self._order = deque()
+        self._changed = None
+        self._worker_tasks = []
+        self._handler = None
+
+    def start(self, handler) -> None:
+        self._handler = handler
+        self._changed = asyncio.Event()
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for user_id in list(self._pending) + list(self._running):
+            self.cancel_user(user_id)
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def user_jobs(self, user_id: int) -> int:
+        return len(self._pending.get(user_id, ())) + len(self._running.get(user_id, ()))
+
+    def pending_count(self) -> int:
+        return sum(len(queue) for queue in self._pending.values())
+
+    def running_count(self) -> int:
+        return sum(len(jobs) for jobs in self._running.values())
+
+    def can_accept(self, user_id: int) -> bool:
+        return self.user_jobs(user_id) < self.per_user_limit
+
+    def estimate_position(self, user_id: int) -> int:
+        """Оценивает место новой задачи пользователя в очереди (0 — начнётся сразу)."""
+        own = len(self._pending.get(user_id, ()))
+        busy = self.running_count()
+        if (
+            not self._pending
+            and busy < self.workers
+            and len(self._running.get(user_id, ())) < self.per_user_active
+        ):
+            return 0
+        ahead = own + sum(
+            min(len(queue), own + 1)
+            for other_id, queue in self._pending.items()
+            if other_id != user_id
+        )
+        return ahead + 1
+
+    def submit(self, job: DownloadJob) -> None:
+        queue = self._pending.get(job.user_id)
+        if queue is None:
+            queue = self._pending[job.user_id] = deque()
+            self._order.append(job.user_id)
+        queue.append(job)
+        self._changed.set()
+
+    def cancel_user(self, user_id: int) -> int:
+        """Отменяет все задачи пользователя — и ожидающие, и выполняющиеся."""
+        cancelled = 0
+        queue = self._pending.pop(user_id, None)
+        if queue:
+            cancelled += len(queue)
+            self._order.remove(user_id)
+        for job in self._running.get(user_id, ()):
+            job.cancelled.set()
+            if job.task is not None:
+                job.task.cancel()
+            cancelled += 1
+        return cancelled
+
+    async def run_blocking(self, job: DownloadJob, func, *args):
+        """Выполняет блокирующую функцию в пуле загрузчиков.
+
+        При отмене задачи дожидается остановки потока, чтобы временные файлы
+        не удалялись у него из-под ног.
+        """
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            job.cancelled.set()
+            await asyncio.wait([future])
+            raise
+
+    def _pick(self):
+        for _ in range(len(self._order)):
+            user_id = self._order[0]
+            self._order.rotate(-1)
+            if len(self._running.get(user_id, ())) >= self.per_user_active:
+                continue
+            queue = self._pending[user_id]
+            job = queue.popleft()
+            if not queue:
+                del self._pending[user_id]
+                self._order.remove(user_id)
+            return job
+        return None
+
+    async def _worker(self) -> None:
+        while True:
+            job = self._pick()
+            if job is None:
+                self._changed.clear()
+                await self._changed.wait()
+                continue
+            self._running.setdefault(job.user_id, set()).add(job)
+            started = time.perf_counter()
+            metrics.observe("bot_download_queue_wait_seconds", started - job.created_at)
+            job.task = asyncio.create_task(self._handler(job))
+            try:
+                await asyncio.wait([job.task])
+                metrics.observe("bot_download_job_duration_seconds", time.perf_counter() - started)
+            finally:
+                running = self._running[job.user_id]
+                running.discard(job)
+                if not running:
+                    del self._running[job.user_id]
+                self._changed.set()
+            if not job.task.cancelled() and job.task.exception() is not None:
+                logger.error("Ошибка в задаче загрузки:", exc_info=job.task.exception())
+
+# ---------------- Кэш отправленных медиа ----------------
+class MediaCache:
+    """LRU-кэш file_id уже отправленных в Telegram медиа.
+
+    Ключ — каноничный идентификатор ролика от экстрактора yt-dlp
+    ("TikTok:7234..."), дополнительно хранятся псевдонимы-ссылки, по
+    которым ролик уже запрашивали. Повторный запрос отвечается отправкой
+    file_id без скачивания и загрузки. Кэш сохраняется на диск.
+
+    Если задано общее хранилище store (многопроцессный режим), записи пишутся
+    в него, а промахи памяти дочитываются оттуда — так file_id, полученный
+    одним воркером, видят все. JSON-файл тогда не используется.
+    """
+
+    def __init__(self, path: str, maxsize: int):
+        self.path = path
+        self.maxsize = maxsize
+        self._entries = LRUCache(maxsize=maxsize)
+        self._aliases = LRUCache(maxsize=maxsize)
+        # Загрузки, которые идут прямо сейчас: ключ -> Future с записью кэша
+        self.inflight = {}
+        self._save_handle = None
+        self.store = None
+
+    def load(self) -> None:
+        if self.store is not None:
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Не удалось прочитать кэш медиа: {e}")
+            return
+        for key, entry in data.get("entries", []):
+            self._entries[key] = entry
+        for url, key in data.get("aliases", []):
+            self._aliases[url] = key
+        logger.info("Кэш медиа загружен: %d записей", len(self._entries))
+
+    def save(self) -> None:
+        self._save_handle = None
+        if self.store is not None:
+            return
+        try:
+            atomic_write_json(self.path, {
+                "entries": list(self._entries.items()),
+                "aliases": list(self._aliases.items()),
+            })
+        except OSError as e:
+            logger.error(f"Не удалось сохранить кэш медиа: {e}")
+
+    def _schedule_save(self) -> None:
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_running_loop().call_later(
+                MEDIA_CACHE_SAVE_DELAY, self.save
+            )
+
+    def _lookup(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None and self.store is not None:
+            entry = self.store.get_json(f"media:{key}")
+            if entry is not None:
+                self._entries[key] = entry
+        return entry
+
+    def get(self, key: str):
+        entry = self._lookup(key)
+        metrics.inc("bot_cache_requests_total", cache="media", result="miss" if entry is None else "hit")
+        return entry
+
+    def get_by_url(self, url: str):
+        key = self._aliases.get(url)
+        if key is None and self.store is not None:
+            key = self.store.get_json(f"alias:{url}")
+            if key is not None:
+                self._aliases[url] = key
+        entry = None if key is None else self._lookup(key)
+        metrics.inc("bot_cache_requests_total", cache="media_url", result="miss" if entry is None else "hit")
+        return key, entry
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def put(self, key: str, entry: dict, aliases=()) -> None:
+        # pop + вставка переносит запись в конец, так порядок на диске близок к LRU
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        for url in aliases:
+            if url:
+                self._aliases[url] = key
+        if self.store is not None:
+            self._put_shared(key, entry, aliases)
+        self._schedule_save()
+
+    def _put_shared(self, key: str, entry: dict, aliases) -> None:
+        items = {f"alias:{url}": key for url in aliases if url}
+        items[f"media:{key}"] = entry
+        writes = self.store.writes()
+        self.store.put_many(items)
+        # Время от времени ограничиваем размер общего хранилища
+        if writes // 1000 != self.store.writes() // 1000:
+            self.store.prune("media:", self.maxsize)
+            self.store.prune("alias:", self.maxsize)
+
+    def discard(self, key: str) -> None:
+        if self.store is not None:
+            self.store.delete(f"media:{key}")
+        if self._entries.pop(key, None) is not None:
+            self._schedule_save()
+
+media_cache = MediaCache(MEDIA_CACHE_PATH, MEDIA_CACHE_SIZE)
+metrics.gauge("bot_media_cache_entries", lambda: len(media_cache))
+metrics.gauge("bot_media_downloads_inflight", lambda: len(media_cache.inflight))
+
+def media_key(info_dict: dict) -> str:
+    return f"{info_dict.get('extractor_key', 'generic')}:{info_dict['id']}"
+
+def media_entry(sent_message):
+    """Достаёт file_id и тип медиа из сообщения, которое вернул Telegram."""
+    for kind in ("video", "animation", "document"):
+        media = getattr(sent_message, kind, None)
+        if media is not None:
+            return {"kind": kind, "file_id": media.file_id}
+    return None
+
+async def send_cached_media(message, entry: dict) -> bool:
+    try:
+        await getattr(message, f"reply_{entry['kind']}")(entry["file_id"])
+        return True
+    except TelegramError as e:
+        logger.warning(f"Не удалось отправить медиа из кэша: {e}")
+        return False
+
+# ---------------- Скачивание видео ----------------
+MEDIA_IMAGES_NOT_SUPPORTED = (
+    "Бот пока что не может скачать картинки с Instagram и TikTok, но AlexProd старается и в будущем добавит эту возможность."
+)
+VIDEO_TOO_LARGE = (
+    f"Видео слишком большое для отправки в Telegram (больше {VIDEO_SIZE_BUDGET // (1024 * 1024)} МБ)."
+)
+
+class YtdlpPool:
+    """Пул заранее созданных экземпляров YoutubeDL.
+
+    Создание YoutubeDL и первый подбор экстрактора стоят сотни миллисекунд,
+    поэтому экземпляры создаются один раз (в фоне при запуске) с
+    экстракторами только из allowed_extractors и переиспользуются. yt_dlp
+    импортируется лениво при создании первого экземпляра. Параметры
+    конкретного запроса (заголовки, формат, шаблон имени, хук прогресса)
+    накладываются на время borrow и затем откатываются.
+    """
+
+    def __init__(self, size: int, params: dict):
+        self.size = size
+        self.params = params
+        self._idle = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._warm_task = None
+
+    def _create(self):
+        started = time.perf_counter()
+        from yt_dlp import YoutubeDL
+        ydl = YoutubeDL(dict(self.params))
+        # Экземпляры экстракторов создаются при первом обращении — делаем это сразу
+        for ie_key in list(ydl._ies):
+            ydl.get_info_extractor(ie_key)
+        metrics.observe("bot_ytdlp_create_seconds", time.perf_counter() - started)
+        return ydl
+
+    def _take(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self._create()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    def warm(self) -> None:
+        """Заполняет пул до size экземпляров (вызывается в отдельном потоке)."""
+        started = time.perf_counter()
+        while True:
+            with self._lock:
+                if self._created >= self.size:
+                    break
+                self._created += 1
+            try:
+                self._idle.put(self._create())
+            except Exception as e:
+                with self._lock:
+                    self._created -= 1
+                logger.error(f"Не удалось прогреть пул yt-dlp: {e}")
+                return
+        logger.info(f"Пул yt-dlp прогрет за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+    def start(self) -> None:
+        self._warm_task = asyncio.create_task(asyncio.to_thread(self.warm))
+
+    def idle_count(self) -> int:
+        return self._idle.qsize()
+
+    @contextlib.contextmanager
+    def borrow(self, ydl_opts: dict):
+        """Выдаёт экземпляр YoutubeDL с наложенными на время параметрами ydl_opts."""
+        started = time.perf_counter()
+        ydl = self._take()
+        saved_params = dict(ydl.params)
+        hooks = ydl_opts.get("progress_hooks", [])
+        try:
+            for name, value in ydl_opts.items():
+                if name == "http_headers":
+                    ydl.params[name] = dict(saved_params[name], **value)
+                elif name == "outtmpl":
+                    ydl.params[name] = {"default": value}
+                elif name == "format":
+                    ydl.params[name] = value
+                    ydl.format_selector = ydl.build_format_selector(value)
+                elif name != "progress_hooks":
+                    ydl.params[name] = value
+            for hook in hooks:
+                ydl.add_progress_hook(hook)
+            metrics.observe("bot_ytdlp_setup_seconds", time.perf_counter() - started)
+            yield ydl
+        finally:
+            # Хуки регистрируются только методом, снимать приходится из внутреннего списка
+            for hook in hooks:
+                ydl._progress_hooks.remove(hook)
+            ydl.params.clear()
+            ydl.params.update(saved_params)
+            ydl.format_selector = None
+            self._idle.put(ydl)
+
+    def close(self) -> None:
+        while True:
+            try:
+                # То же, что выход из with YoutubeDL(...): сохранение cookies и т.п.
+                self._idle.get_nowait().__exit__(None, None, None)
+            except queue.Empty:
+                break
+
+ytdlp_params = {
+    'outtmpl': '%(id)s.%(ext)s',
+    'quiet': True,
+    'noprogress': True,
+    'geo_bypass': True,
+    'geo_bypass_country': 'US',
+    'allowed_extractors': YTDLP_EXTRACTORS,
+    'http_headers': {'User-Agent': BROWSER_USER_AGENT},
+}
+if FFMPEG_AVAILABLE:
+    # Только смена контейнера на mp4 без перекодирования
+    ytdlp_params['merge_output_format'] = 'mp4'
+    ytdlp_params['postprocessors'] = [{'key': 'FFmpegVideoRemuxer', 'preferedformat': 'mp4'}]
+ytdlp_pool = YtdlpPool(DOWNLOAD_WORKERS, ytdlp_params)
+metrics.gauge("bot_ytdlp_pool_idle", ytdlp_pool.idle_count)
+
+def ytdlp_extract(url: str, ydl_opts: dict) -> dict:
+    with ytdlp_pool.borrow(ydl_opts) as ydl:
+        info_dict = ydl.extract_info(url, download=False)
+    if info_dict.get("_type") == "playlist":
+        # Карусели и подборки: отправляем первый ролик
+        info_dict = next((entry for entry in info_dict.get("entries") or () if entry), None)
+        if info_dict is None:
+            raise ValueError(f"Пустой плейлист: {url}")
+    return info_dict
+
+def ytdlp_download(info_dict: dict, ydl_opts: dict) -> str:
+    with ytdlp_pool.borrow(ydl_opts) as ydl:
+        info_dict = ydl.process_ie_result(info_dict, download=True)
+    # После склейки и смены контейнера итоговый путь лежит в requested_downloads
+    downloads = info_dict.get("requested_downloads")
+    if not downloads:
+        raise RuntimeError("yt-dlp не вернул скачанный файл")
+    filepath = downloads[0].get("filepath")
+    if not filepath:
+        # yt-dlp пропускает файл больше max_filesize, не поднимая ошибку
+        raise MediaTooLarge()
+    return filepath
+
+class MediaTooLarge(Exception):
+    """Файл превышает лимит загрузки в Telegram."""
+
+
+def format_size(fmt: dict, duration=None):
+    """Размер формата в байтах: точный, приблизительный или по битрейту (None, если неизвестен)."""
+    size = fmt.get("filesize") or fmt.get("filesize_approx")
+    if not size and fmt.get("tbr") and duration:
+        # tbr — кбит/с
+        size = fmt["tbr"] * duration * 125
+    return size or None
+
+def select_format(info_dict: dict, budget: int, can_merge: bool = FFMPEG_AVAILABLE) -> str:
+    """Выбирает лучший вариант ролика, который уложится в budget байт.
+
+    Рассматриваются готовые форматы с видео и звуком и, если есть ffmpeg,
+    пары «видео + лучший подходящий звук». Среди укладывающихся в бюджет
+    берётся вариант с наибольшим разрешением и битрейтом, при равенстве —
+    в контейнере mp4. Возвращает строку формата для yt-dlp. Если известны
+    размеры всех вариантов и ни один не проходит, поднимает MediaTooLarge
+    ещё до скачивания.
+    """
+    duration = info_dict.get("duration")
+    formats = info_dict.get("formats")
+    if not formats:
+        # Единственный вариант без списка форматов
+        size = format_size(info_dict, duration)
+        if size and size > budget:
+            raise MediaTooLarge()
+        return "best"
+    audio = [
+        f for f in formats
+        if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")
+    ]
+    candidates = []
+    for f in formats:
+        if f.get("vcodec") == "none":
+            continue
+        size = format_size(f, duration)
+        if f.get("acodec") != "none" or not audio:
+            # acodec None — экстрактор не знает кодеков, обычно это готовый ролик со звуком
+            candidates.append((f, None, size))
+        elif can_merge:
+            for a in audio:
+                a_size = format_size(a, duration)
+                candidates.append((f, a, size + a_size if size and a_size else None))
+    if not candidates:
+        return "best"
+
+    def quality(candidate):
+        f, a, _ = candidate
+        return (
+            f.get("height") or 0,
+            (f.get("tbr") or 0) + (a.get("tbr") or 0 if a else 0),
+            f.get("ext") == "mp4",
+        )
+
+    fitting = [c for c in candidates if c[2] is not None and c[2] <= budget]
+    unknown = [c for c in candidates if c[2] is None]
+    if fitting:
+        best = max(fitting, key=quality)
+    elif unknown:
+        # Размер не указан — пробуем наименьший по качеству, max_filesize оборвёт скачивание при превышении
+        best = min(unknown, key=quality)
+    else:
+        raise MediaTooLarge()
+    video, audio_format, _ = best
+    if audio_format is None:
+        return video["format_id"]
+    return f"{video['format_id']}+{audio_format['format_id']}"
+
+def sniff_media_type(head: bytes):
+    """Определяет MIME-тип по первым байтам файла (None, если не распознан)."""
+    if head[4:8] == b"ftyp":
+        return "video/quicktime" if head[8:12] == b"qt  " else "video/mp4"
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "video/webm"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+@contextlib.contextmanager
+def media_work_dir():
+    """Временный каталог для файлов одной загрузки.
+
+    tempfile создаёт каталог с правами 0700, а локальный сервер Bot API
+    читает файлы под своим пользователем — в этом режиме права расширяются.
+    """
+    with tempfile.TemporaryDirectory(dir=MEDIA_WORK_DIR) as tmpdirname:
+        if LOCAL_BOT_API_URL:
+            os.chmod(tmpdirname, 0o755)
+        yield tmpdirname
+
+async def stream_download(url: str, dest, referer: str) -> str:
+    """Потоково скачивает url в файл dest и возвращает MIME-тип содержимого.
+
+    Тип определяется по первым байтам, заголовок Content-Type используется
+    только если сигнатура не распознана. Всё, что не видео, дальше первого
+    чанка не качается. При превышении VIDEO_SIZE_BUDGET поднимается
+    MediaTooLarge, не дожидаясь конца файла.
+    """
+    async with http_client().stream("GET", url, headers={"Referer": referer}, timeout=15) as response:
+        response.raise_for_status()
+        length = response.headers.get("Content-Length", "")
+        content_type = None
+        size = 0
+        async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+            if content_type is None:
+                header_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+                content_type = sniff_media_type(chunk) or header_type
+                if not content_type.startswith("video/"):
+                    return content_type
+                if length.isdigit() and int(length) > VIDEO_SIZE_BUDGET:
+                    raise MediaTooLarge()
+            size += len(chunk)
+            metrics.inc("bot_downloaded_bytes_total", len(chunk), source="direct")
+            if size > VIDEO_SIZE_BUDGET:
+                raise MediaTooLarge()
+            dest.write(chunk)
+        return content_type or ""
+
+@track_handler
 async def video_by_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text.strip()
     if await check_back_to_menu(text, update):
@@ -365,93 +2051,460 @@ async def video_by_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Я могу обрабатывать только ссылки с TikTok или Instagram. Попробуйте другую ссылку."
         )
         return VIDEO
-    await update.message.reply_text("Скачиваю медиа, пожалуйста, подождите...")
-    expanded_url = expand_url(text)
-    if "instagram.com" in expanded_url:
-        referer = "https://www.instagram.com/"
+    key, entry = media_cache.get_by_url(text)
+    if entry is not None:
+        if await send_cached_media(update.message, entry):
+            await update.message.reply_text(
+                "Если хотите, отправьте другую ссылку или нажмите 'В меню' для возврата в главное меню."
+            )
+            return VIDEO
+        media_cache.discard(key)
+    user_id = update.effective_user.id
+    if not download_scheduler.can_accept(user_id):
+        await update.message.reply_text(
+            "У вас уже есть загрузки в очереди. Дождитесь их завершения или нажмите 'В меню', чтобы отменить."
+        )
+        return VIDEO
+    job = DownloadJob(user_id, update.message, text)
+    position = download_scheduler.estimate_position(user_id)
+    if position:
+        status_text = f"Ссылка добавлена в очередь, ваша позиция: {position}. Пожалуйста, подождите..."
     else:
-        referer = "https://www.tiktok.com/"
-    ydl_opts = {
-        'outtmpl': '%(id)s.%(ext)s',
-        'format': 'mp4',
-        'quiet': True,
-        'http_headers': {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
-                          '(KHTML, like Gecko) Chrome/99.0.4844.51 Safari/537.36',
-            'Referer': referer
-        },
-        'geo_bypass': True,
-        'geo_bypass_country': 'US',
-        'noprogress': True
-    }
-    success = False
+        status_text = "Скачиваю медиа, пожалуйста, подождите..."
+    job.status_message = await update.message.reply_text(status_text)
+    download_scheduler.submit(job)
+    return VIDEO
+
+async def ytdlp_download_and_send(job: DownloadJob, key: str, info_dict: dict, ydl_opts: dict, aliases) -> bool:
+    """Скачивает ролик, отправляет его и запоминает file_id в кэше.
+
+    Пока загрузка идёт, другие запросы того же ролика ждут её Future
+    в media_cache.inflight вместо собственного скачивания.
+    """
+    message = job.message
+    future = asyncio.get_running_loop().create_future()
+    media_cache.inflight[key] = future
+    entry = None
     try:
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            ydl_opts['outtmpl'] = os.path.join(tmpdirname, '%(id)s.%(ext)s')
-            with YoutubeDL(ydl_opts) as ydl:
-                info_dict = ydl.extract_info(expanded_url, download=True)
-                filename = ydl.prepare_filename(info_dict)
+        ydl_opts = dict(
+            ydl_opts,
+            format=select_format(info_dict, VIDEO_SIZE_BUDGET),
+            max_filesize=VIDEO_SIZE_BUDGET,
+            concurrent_fragment_downloads=YTDLP_CONCURRENT_FRAGMENTS,
+        )
+        with media_work_dir() as tmpdirname:
+            ydl_opts["outtmpl"] = os.path.join(tmpdirname, '%(id)s.%(ext)s')
+            with metrics.timer("bot_outbound_duration_seconds", dependency="ytdlp_download"):
+                filename = await download_scheduler.run_blocking(job, ytdlp_download, info_dict, ydl_opts)
+            if not os.path.exists(filename):
+                raise FileNotFoundError(filename)
+            size = os.path.getsize(filename)
+            if size > VIDEO_SIZE_BUDGET:
+                raise MediaTooLarge()
+            metrics.inc("bot_downloaded_bytes_total", size, source="ytdlp")
             ext = os.path.splitext(filename)[1].lower()
-            if ext in ['.mp4', '.mov', '.mkv', '.webm']:
-                with open(filename, 'rb') as media_file:
-                    await update.message.reply_video(video=media_file)
-                success = True
-            elif ext in ['.jpg', '.jpeg', '.png', '.webp']:
-                await update.message.reply_text(
-                    "Бот пока что не может скачать картинки с Instagram и TikTok, но AlexProd старается и в будущем добавит эту возможность."
-                )
-                success = True
-            else:
-                with open(filename, 'rb') as media_file:
-                    await update.message.reply_document(document=media_file)
-                success = True
+            if ext in ['.jpg', '.jpeg', '.png', '.webp']:
+                await message.reply_text(MEDIA_IMAGES_NOT_SUPPORTED)
+                return True
+            with contextlib.ExitStack() as stack, \
+                    metrics.timer("bot_outbound_duration_seconds", dependency="telegram_upload"):
+                # Локальный сервер Bot API сам читает файл с общего тома — передаём только путь
+                if LOCAL_BOT_API_URL:
+                    media_file = Path(filename)
+                    media_file.chmod(0o644)
+                else:
+                    media_file = stack.enter_context(open(filename, 'rb'))
+                if ext in ['.mp4', '.mov', '.mkv', '.webm']:
+                    sent = await message.reply_video(video=media_file)
+                else:
+                    sent = await message.reply_document(document=media_file)
+            metrics.inc("bot_uploaded_bytes_total", size)
+        entry = media_entry(sent)
+        if entry is not None:
+            media_cache.put(key, entry, aliases)
+        return True
+    finally:
+        if media_cache.inflight.get(key) is future:
+            del media_cache.inflight[key]
+        future.set_result(entry)
+
+async def process_download(job: DownloadJob):
+    """Скачивает медиа по ссылке из заявки и отправляет его пользователю."""
+    message = job.message
+    await job.set_status("Скачиваю медиа, пожалуйста, подождите...")
+    # Если ссылку не удалось раскрыть, прямое скачивание пробует исходную
+    expanded_url = job.url
+    referer = "https://www.tiktok.com/"
+    success = False
+    try:
+        expanded_url = await expand_url(job.url)
+        if "instagram.com" in expanded_url:
+            referer = "https://www.instagram.com/"
+        # Общие параметры заданы в ytdlp_params, здесь только то, что зависит от запроса
+        ydl_opts = {
+            'http_headers': {'Referer': referer},
+            'progress_hooks': [job.progress_hook]
+        }
+        with metrics.timer("bot_outbound_duration_seconds", dependency="ytdlp_extract"):
+            info_dict = await download_scheduler.run_blocking(job, ytdlp_extract, expanded_url, ydl_opts)
+        key = media_key(info_dict)
+        aliases = (job.url, expanded_url, info_dict.get("webpage_url"))
+        entry = media_cache.get(key)
+        if entry is None and key in media_cache.inflight:
+            # Этот же ролик уже скачивается для другого пользователя — ждём его file_id
+            entry = await asyncio.shield(media_cache.inflight[key])
+        if entry is not None and await send_cached_media(message, entry):
+            media_cache.put(key, entry, aliases)
+            success = True
+        else:
+            media_cache.discard(key)
+            success = await ytdlp_download_and_send(job, key, info_dict, ydl_opts, aliases)
+    except MediaTooLarge:
+        await message.reply_text(VIDEO_TOO_LARGE)
+        success = True
     except Exception:
         logger.error("Ошибка при скачивании через yt-dlp:\n%s", traceback.format_exc())
     if not success:
         try:
-            response = requests.get(expanded_url, timeout=15)
-            response.raise_for_status()
-            content_type = response.headers.get('Content-Type', '').lower()
-            if 'image' in content_type:
-                await update.message.reply_text(
-                    "Бот пока что не может скачать картинки с Instagram и TikTok, но AlexProd старается и в будущем добавит эту возможность."
-                )
-                success = True
-            elif 'video' in content_type:
-                ext = mimetypes.guess_extension(content_type)
-                if not ext:
-                    ext = ".mp4"
-                filename = "downloaded_file" + ext
-                file_stream = BytesIO(response.content)
-                file_stream.name = filename
-                await update.message.reply_video(video=file_stream)
-                success = True
-            else:
-                await update.message.reply_text(
-                    "Не удалось определить тип медиа. Возможно, ссылка неправильная или недоступна."
-                )
+            with contextlib.ExitStack() as stack:
+                if LOCAL_BOT_API_URL:
+                    tmpdirname = stack.enter_context(media_work_dir())
+                    media_file = stack.enter_context(open(os.path.join(tmpdirname, "downloaded_file"), "w+b"))
+                else:
+                    media_file = stack.enter_context(tempfile.SpooledTemporaryFile(max_size=DOWNLOAD_SPOOL_SIZE))
+                with metrics.timer("bot_outbound_duration_seconds", dependency="direct_download"):
+                    content_type = await stream_download(expanded_url, media_file, referer)
+                if content_type.startswith('image/'):
+                    await message.reply_text(MEDIA_IMAGES_NOT_SUPPORTED)
+                    success = True
+                elif content_type.startswith('video/'):
+                    ext = mimetypes.guess_extension(content_type)
+                    if not ext:
+                        ext = ".mp4"
+                    if LOCAL_BOT_API_URL:
+                        # Серверу нужен путь с расширением, содержимое он прочитает сам
+                        media_file.close()
+                        video = Path(media_file.name).rename(media_file.name + ext)
+                        video.chmod(0o644)
+                        size = video.stat().st_size
+                    else:
+                        media_file.seek(0)
+                        # python-telegram-bot всё равно читает файл целиком; размер уже ограничен лимитом
+                        video = media_file.read()
+                        size = len(video)
+                    with metrics.timer("bot_outbound_duration_seconds", dependency="telegram_upload"):
+                        await message.reply_video(video=video, filename="downloaded_file" + ext)
+                    metrics.inc("bot_uploaded_bytes_total", size)
+                    success = True
+                else:
+                    await message.reply_text(
+                        "Не удалось определить тип медиа. Возможно, ссылка неправильная или недоступна."
+                    )
+        except MediaTooLarge:
+            await message.reply_text(VIDEO_TOO_LARGE)
+            success = True
         except Exception:
             logger.error("Ошибка при скачивании напрямую:\n%s", traceback.format_exc())
     if not success:
-        await update.message.reply_text(
+        await message.reply_text(
             "Не удалось скачать медиа, Возможно, ссылка неправильная или недоступна."
         )
-    await update.message.reply_text(
+    await job.set_status("Готово." if success else "Загрузка не удалась.")
+    await message.reply_text(
         "Если хотите, отправьте другую ссылку или нажмите 'В меню' для возврата в главное меню."
     )
-    return VIDEO
 
-async def set_bot_commands(app):
+download_scheduler = DownloadScheduler(
+    DOWNLOAD_WORKERS, DOWNLOAD_PER_USER_ACTIVE, DOWNLOAD_PER_USER_LIMIT
+)
+metrics.gauge("bot_download_queue_pending", download_scheduler.pending_count)
+metrics.gauge("bot_download_jobs_running", download_scheduler.running_count)
+
+# ---------------- Исходящие запросы к Bot API ----------------
+# Полосы приоритета: ответы пользователям идут раньше фоновых отправок
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+# Методы, которые по умолчанию считаются фоновыми (тяжёлые загрузки и обновления прогресса)
+BULK_ENDPOINTS = {"sendVideo", "sendDocument", "sendAnimation", "editMessageText"}
+# При таком числе корзин по чатам неактивные удаляются
+CHAT_BUCKETS_SWEEP_SIZE = 10000
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity в запасе."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "lock")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def delay(self) -> float:
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    async def acquire(self) -> None:
+        # Блокировка сохраняет порядок запросов к одному чату
+        async with self.lock:
+            while (delay := self.delay()) > 0:
+                await asyncio.sleep(delay)
+            self.take()
+
+    def idle(self) -> bool:
+        return not self.lock.locked() and self.delay() == 0 and self.tokens >= self.capacity
+
+
+class OutboundScheduler(BaseRateLimiter):
+    """Планировщик исходящих запросов, учитывающий лимиты Telegram.
+
+    Каждый запрос с chat_id сначала берёт токен из корзины своего чата, затем
+    встаёт в общую очередь с глобальной корзиной. Очередь упорядочена по
+    сроку: у фоновых запросов (PRIORITY_BULK) он сдвинут на bulk_delay
+    секунд, поэтому ответы пользователям обгоняют загрузки и уведомления
+    админу, но фоновые запросы не голодают. На RetryAfter очередь
+    приостанавливается на указанное время и запрос повторяется.
+
+    Приоритет можно задать явно через rate_limit_args методов бота.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, group_rate: float,
+                 chat_burst: float, max_retries: int, bulk_delay: float):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.bulk_delay = bulk_delay
+        self.set_global_rate(global_rate)
+        self._chats = {}
+        # Куча (срок, порядковый номер, Future ожидающего запроса)
+        self._queue = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._paused_until = 0.0
+        self._dispatcher = None
+
+    async def initialize(self) -> None:
+        # Бот инициализируют и приложение, и Updater — диспетчер нужен один
+        if self._dispatcher is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        for _, _, future in self._queue:
+            future.cancel()
+        self._queue.clear()
+
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def set_global_rate(self, rate: float) -> None:
+        """Задаёт общий лимит запросов в секунду."""
+        # В корзине должен помещаться хотя бы один токен, иначе при rate < 1 очередь встанет
+        self._global = TokenBucket(rate, max(1.0, rate))
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= CHAT_BUCKETS_SWEEP_SIZE:
+                self._chats = {key: b for key, b in self._chats.items() if not b.idle()}
+            # У групп и каналов (отрицательный id или @username) лимит строже
+            private = isinstance(chat_id, int) and chat_id > 0
+            rate = self.chat_rate if private else self.group_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    async def _dispatch(self) -> None:
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            delay = self._global.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._queue)
+            if future.done():
+                # Ожидающий запрос уже отменён
+                continue
+            self._global.take()
+            future.set_result(None)
+
+    async def _acquire(self, chat_id, priority: int) -> None:
+        await self._chat_bucket(chat_id).acquire()
+        deadline = time.monotonic() + (self.bulk_delay if priority == PRIORITY_BULK else 0)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (deadline, next(self._seq), future))
+        self._wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # Без чата (answerInlineQuery, getMe и т.п.) лимиты на сообщения не действуют
+            return await callback(*args, **kwargs)
+        with contextlib.suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        else:
+            priority = PRIORITY_BULK if endpoint in BULK_ENDPOINTS else PRIORITY_INTERACTIVE
+        lane = "bulk" if priority == PRIORITY_BULK else "interactive"
+        for attempt in range(self.max_retries + 1):
+            queued = time.perf_counter()
+            await self._acquire(chat_id, priority)
+            metrics.observe("bot_outbound_queue_seconds", time.perf_counter() - queued, lane=lane)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                metrics.inc("bot_outbound_retry_after_total", endpoint=endpoint)
+                if attempt == self.max_retries:
+                    raise
+                logger.warning(f"Telegram ограничил частоту запросов, пауза {exc.retry_after} с")
+                self._paused_until = max(self._paused_until, time.monotonic() + exc.retry_after + 0.1)
+
+outbound_scheduler = OutboundScheduler(
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_GROUP_RATE,
+    OUTBOUND_CHAT_BURST, OUTBOUND_MAX_RETRIES, OUTBOUND_BULK_DELAY
+)
+metrics.gauge("bot_outbound_queue_depth", outbound_scheduler.queue_depth)
+
+# ---------------- Обработка апдейтов ----------------
+def chat_key(update: object):
+    """Чат, к которому относится апдейт (для inline-запросов — пользователь)."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
+
+class ChatOrderedApplication(Application):
+    """Application, который обрабатывает разные чаты параллельно, а один чат — по порядку.
+
+    Блокировка на чат сохраняет порядок апдейтов внутри чата, без чего
+    переходы состояний ConversationHandler перестали бы быть корректными.
+    Слот из CONCURRENT_UPDATES берётся только после блокировки чата, поэтому
+    апдейты, ждущие своей очереди в загруженном чате, не занимают слоты и не
+    задерживают другие чаты. Семафор самого PTB (concurrent_updates) берётся
+    раньше блокировки, поэтому он лишь ограничивает число принятых апдейтов
+    (MAX_PENDING_UPDATES).
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # chat_id -> [asyncio.Lock, число апдейтов, ждущих или держащих блокировку]
+        self._chat_locks = {}
+        self._update_slots = asyncio.Semaphore(CONCURRENT_UPDATES)
+
+    async def process_update(self, update: object) -> None:
+        key = chat_key(update)
+        if key is None:
+            async with self._update_slots:
+                await super().process_update(update)
+            return
+        slot = self._chat_locks.get(key)
+        if slot is None:
+            slot = self._chat_locks[key] = [asyncio.Lock(), 0]
+        slot[1] += 1
+        try:
+            async with slot[0], self._update_slots:
+                await super().process_update(update)
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self._chat_locks[key]
+
+async def set_bot_commands(bot):
     commands = [
         BotCommand("start", "Начало работы с ботом"),
         BotCommand("cancel", "Отменить текущий диалог")
     ]
-    await app.bot.set_my_commands(commands)
+    await bot.set_my_commands(commands)
 
-def main():
-    app = ApplicationBuilder().token(TOKEN).post_init(set_bot_commands).build()
+async def post_init(app):
+    # В многопроцессном режиме воркер знает свою долю чатов, команды задаёт приёмник
+    shard = app.bot_data.get("shard")
+    if shard is None:
+        await set_bot_commands(app.bot)
+    rate_store.start(SHARED_POLL_INTERVAL if rate_store.follower else RATES_REFRESH_INTERVAL)
+    media_cache.load()
+    if MEDIA_WORK_DIR:
+        os.makedirs(MEDIA_WORK_DIR, exist_ok=True)
+    download_scheduler.start(process_download)
+    if ADMIN_CHAT_ID and owns_chat(shard, ADMIN_CHAT_ID):
+        feedback_log.start(app.bot, ADMIN_CHAT_ID, FEEDBACK_FLUSH_INTERVAL)
+    if METRICS_PORT:
+        port = METRICS_PORT if shard is None else METRICS_PORT + 1 + shard[0]
+        await metrics.start_server(METRICS_HOST, port)
+    # yt-dlp нужен только для видео: импорт и прогрев пула идут в фоне, не задерживая запуск
+    ytdlp_pool.start()
+    startup = time.perf_counter() - STARTED_AT
+    metrics.gauge("bot_startup_seconds", lambda: startup)
+    logger.info(f"Бот запущен за {startup * 1000:.0f} мс")
+
+async def post_shutdown(app):
+    await rate_store.stop()
+    await download_scheduler.stop()
+    await feedback_log.stop()
+    media_cache.save()
+    ytdlp_pool.close()
+    await close_http_client()
+    await metrics.stop_server()
+    shared_store.close()
+
+def local_bot_api_url(prefix: str):
+    """Адрес локального сервера Bot API с префиксом ("bot" или "file/bot"), None — облачный API."""
+    return f"{LOCAL_BOT_API_URL.rstrip('/')}/{prefix}" if LOCAL_BOT_API_URL else None
+
+def build_application(token: str, base_url: str = None, receive_updates: bool = True) -> Application:
+    """Собирает приложение со всеми обработчиками.
+
+    base_url — другой адрес Bot API; receive_updates=False — без Updater,
+    апдейты кладёт в update_queue кто-то другой (воркер многопроцессного режима).
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .application_class(ChatOrderedApplication)
+        .concurrent_updates(MAX_PENDING_UPDATES)
+        .rate_limiter(outbound_scheduler)
+        .context_types(ContextTypes(user_data=Session))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    base_url = base_url or local_bot_api_url("bot")
+    if base_url:
+        builder = builder.base_url(base_url)
+    if LOCAL_BOT_API_URL:
+        builder = builder.base_file_url(local_bot_api_url("file/bot")).local_mode(True)
+    if not receive_updates:
+        builder = builder.updater(None)
+    app = builder.build()
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", start)],
+        entry_points=[
+            CommandHandler("start", start),
+            # После /cancel или истечения диалога любое сообщение в личке продолжает с главного меню
+            MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, menu),
+        ],
         states={
             MENU: [MessageHandler(filters.TEXT & ~filters.COMMAND, menu)],
             HEIGHT: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_height)],
@@ -464,12 +2517,209 @@ def main():
             CURRENCY_TO: [MessageHandler(filters.TEXT & ~filters.COMMAND, currency_to)],
             CURRENCY_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, currency_amount)],
             FEEDBACK: [MessageHandler(filters.TEXT & ~filters.COMMAND, feedback)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)],
         },
-        fallbacks=[CommandHandler("cancel", cancel)]
+        fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT or None
     )
     app.add_handler(conv_handler)
+    app.add_handler(CommandHandler("reviews", feedback_digest))
+    app.add_handler(MessageHandler(filters.Document.FileExtension("csv"), bulk_calories))
+    app.add_handler(InlineQueryHandler(inline_query))
+    metrics.gauge("bot_sessions", lambda: len(app.user_data))
+    # Считается при каждом сборе метрик обходом всех сессий
+    metrics.gauge("bot_sessions_bytes", lambda: sum(session.footprint() for session in app.user_data.values()))
+    return app
+
+# ---------------- Многопроцессный режим ----------------
+def owns_chat(shard, chat_id) -> bool:
+    """Обслуживает ли воркер shard = (номер, всего) чат chat_id (None — однопроцессный режим)."""
+    if shard is None:
+        return True
+    index, workers = shard
+    try:
+        return int(chat_id) % workers == index
+    except ValueError:
+        # @username канала — такие чаты достаются первому воркеру
+        return index == 0
+
+class ShardRouter:
+    """Раздаёт апдейты процессам-воркерам по chat_id.
+
+    Каждый воркер — отдельный процесс с обычным приложением (ConversationHandler,
+    очередь загрузок, пул yt-dlp), получающий апдейты своей доли чатов через
+    pipe. Поэтому состояние диалога пользователя всегда живёт в одном
+    процессе, а CPU-тяжёлая работа распределяется по ядрам. Порядок апдейтов
+    внутри воркера сохраняется, упавший воркер перезапускается.
+    """
+
+    def __init__(self, token: str, workers: int, base_url: str = None):
+        self.token = token
+        self.workers = workers
+        self.base_url = base_url
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = [None] * workers
+        self._conns = [None] * workers
+        self._queues = [asyncio.Queue() for _ in range(workers)]
+        self._senders = []
+
+    def _spawn(self, index: int) -> None:
+        recv_conn, send_conn = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=run_worker, args=(self.token, index, self.workers, recv_conn, self.base_url),
+            name=f"bot-worker-{index}", daemon=True
+        )
+        process.start()
+        recv_conn.close()
+        self._processes[index] = process
+        self._conns[index] = send_conn
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            self._spawn(index)
+        self._senders = [asyncio.create_task(self._send_loop(index)) for index in range(self.workers)]
+
+    def shard_of(self, update) -> int:
+        key = chat_key(update)
+        return 0 if key is None else key % self.workers
+
+    def route(self, update: Update) -> None:
+        index = self.shard_of(update)
+        self._queues[index].put_nowait(json.dumps(update.to_dict(), ensure_ascii=False).encode())
+        metrics.inc("bot_updates_routed_total", shard=index)
+
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def _send_loop(self, index: int) -> None:
+        queue = self._queues[index]
+        while True:
+            data = await queue.get()
+            while True:
+                try:
+                    await asyncio.to_thread(self._conns[index].send_bytes, data)
+                    break
+                except OSError:
+                    logger.error(f"Воркер {index} недоступен, перезапускаю")
+                    metrics.inc("bot_worker_restarts_total", shard=index)
+                    self._conns[index].close()
+                    await asyncio.to_thread(self._processes[index].join, 5)
+                    self._spawn(index)
+            queue.task_done()
+
+    async def stop(self, timeout: float = 10) -> None:
+        # Досылаем то, что уже принято, затем закрываем pipe — воркеры завершаются сами
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        for task in self._senders:
+            task.cancel()
+        await asyncio.gather(*self._senders, return_exceptions=True)
+        for conn in self._conns:
+            conn.close()
+        for process in self._processes:
+            await asyncio.to_thread(process.join, WORKER_SHUTDOWN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+
+async def serve_shard(token: str, index: int, workers: int, conn, base_url: str = None) -> None:
+    """Работа воркера: приложение без Updater, апдейты приходят из pipe."""
+    rate_store.shared = shared_store
+    rate_store.follower = True
+    media_cache.store = shared_store
+    # Глобальный лимит Telegram общий на бота — делим его между воркерами
+    outbound_scheduler.set_global_rate(OUTBOUND_GLOBAL_RATE / workers)
+    app = build_application(token, base_url=base_url, receive_updates=False)
+    app.bot_data["shard"] = (index, workers)
+    loop = asyncio.get_running_loop()
+    async with app:
+        await app.post_init(app)
+        await app.start()
+        while True:
+            try:
+                data = await loop.run_in_executor(None, conn.recv_bytes)
+            except EOFError:
+                break
+            await app.update_queue.put(Update.de_json(json.loads(data), app.bot))
+        await app.stop()
+        await app.post_shutdown(app)
+
+def run_worker(token: str, index: int, workers: int, conn, base_url: str = None) -> None:
+    # Ctrl+C получает вся группа процессов, а воркер завершается по закрытию pipe
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_shard(token, index, workers, conn, base_url))
+
+async def run_receiver(token: str, workers: int, base_url: str = None,
+                       stop_event: asyncio.Event = None) -> None:
+    """Процесс-приёмник: получает апдейты (polling или webhook) и раздаёт их воркерам.
+
+    Заодно он единственный обновляет курсы валют в общем хранилище.
+    """
+    if stop_event is None:
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+    bot = Bot(
+        token,
+        base_url=base_url or local_bot_api_url("bot") or "https://api.telegram.org/bot",
+        base_file_url=local_bot_api_url("file/bot") or "https://api.telegram.org/file/bot",
+        local_mode=bool(LOCAL_BOT_API_URL),
+    )
+    updater = Updater(bot, asyncio.Queue())
+    router = ShardRouter(token, workers, base_url)
+    metrics.gauge("bot_router_queue_depth", router.queue_depth)
+    rate_store.shared = shared_store
+    async with updater:
+        await set_bot_commands(bot)
+        rate_store.start(RATES_REFRESH_INTERVAL)
+        router.start()
+        if METRICS_PORT:
+            await metrics.start_server(METRICS_HOST, METRICS_PORT)
+        if WEBHOOK_URL:
+            await updater.start_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+        else:
+            await updater.start_polling()
+
+        async def forward():
+            while True:
+                router.route(await updater.update_queue.get())
+
+        forward_task = asyncio.create_task(forward())
+        logger.info(f"Приёмник запущен, воркеров: {workers}")
+        await stop_event.wait()
+        await updater.stop()
+        forward_task.cancel()
+        while not updater.update_queue.empty():
+            router.route(updater.update_queue.get_nowait())
+        await router.stop()
+        await rate_store.stop()
+        await metrics.stop_server()
+    shared_store.close()
+
+def main():
+    if WORKER_PROCESSES > 1:
+        asyncio.run(run_receiver(TOKEN, WORKER_PROCESSES))
+        return
+    app = build_application(TOKEN)
     logger.info("Бот запущен...")
-    app.run_polling()
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file